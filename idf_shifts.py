@@ -1,8 +1,17 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import os
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from uuid import uuid4
+from bisect import bisect_left, bisect_right, insort
+from operator import itemgetter
 from datetime import datetime, timedelta, date, time
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, ForeignKey, Time, Boolean, text
-from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, ForeignKey, Time, Boolean, text, select, insert, update, func, bindparam
+from sqlalchemy.orm import declarative_base, sessionmaker, aliased
+from sqlalchemy.pool import StaticPool
 
 # ==========================================
 # 0. הגדרות תצוגה ו-RTL
@@ -167,7 +176,33 @@ class SystemSetting(Base):
     key = Column(String, primary_key=True)
     value = Column(String)
 
-engine = create_engine('sqlite:///shifts_v8.db', connect_args={'check_same_thread': False})
+class AssignmentJournal(Base):
+    # יומן הוספה-בלבד של שינויי שיבוץ: שורה לכל משמרת שהשתנתה בפעולה (op_id משותף לפעולה)
+    __tablename__ = 'assignment_journal'
+    id = Column(Integer, primary_key=True)
+    op_id = Column(String, nullable=False, index=True)
+    shift_id = Column(Integer, nullable=False)
+    old_user_ids = Column(String, default="")
+    new_user_ids = Column(String, default="")
+    source = Column(String, nullable=False)
+    reverts_op_id = Column(String, nullable=True, index=True)
+    created_at = Column(DateTime, default=datetime.now, index=True)
+
+class Job(Base):
+    __tablename__ = 'jobs'
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)
+    params = Column(String, default="{}")
+    status = Column(String, default="PENDING")
+    progress = Column(Float, default=0.0)
+    message = Column(String, default="")
+    cancel_requested = Column(Boolean, default=False)
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime, nullable=True)
+
+# SHIFTS_DB_URL=sqlite:// מריץ על DB בזיכרון (בדיקות); חיבור יחיד משותף כדי שכל הסשנים יראו את אותו DB
+DB_URL = os.environ.get("SHIFTS_DB_URL", "sqlite:///shifts_v8.db")
+engine = create_engine(DB_URL, connect_args={'check_same_thread': False}, **({"poolclass": StaticPool} if DB_URL == "sqlite://" else {}))
 Base.metadata.create_all(engine)
 
 with engine.connect() as conn:
@@ -191,29 +226,277 @@ def is_black_shift(start_dt, end_dt):
     midpoint = start_dt + (end_dt - start_dt) / 2
     return 0 <= midpoint.hour < 6
 
-def get_shift_warnings(db_session, target_date, days_to_add=1):
-    start_dt = datetime.combine(target_date, time(0,0))
-    end_dt = start_dt + timedelta(days=days_to_add) 
-    shifts = db_session.query(Shift).filter(Shift.start_time >= start_dt, Shift.start_time < end_dt).all()
+class IntervalIndex:
+    # אינדקס אינטרוולים לכל חייל: רשימות ממוינות לפי התחלה ולפי סיום + bisect.
+    # אינטרוולים קצרים (עד long_after דקות) נסרקים רק בטווח התחלות (start - long_after, end);
+    # ארוכים (חופשה של כמה ימים) נשמרים ברשימה קטנה נפרדת שנבדקת תמיד - כך חיפוש חפיפה
+    # הוא O(log n + k + L) ואינטרוול ארוך אחד לא הופך כל שאילתה לסריקה מלאה.
+    def __init__(self, long_after=24 * 60):
+        self.long_after = long_after
+        self._by_start = {}
+        self._by_end = {}
+        self._short = {}
+        self._long = {}
+
+    def add(self, uid, start, end, key):
+        insort(self._by_start.setdefault(uid, []), (start, end, key))
+        insort(self._by_end.setdefault(uid, []), (end, start, key))
+        if end - start > self.long_after:
+            self._long.setdefault(uid, []).append((start, end, key))
+        else:
+            insort(self._short.setdefault(uid, []), (start, end, key))
+
+    def remove(self, uid, start, end, key):
+        for items, item in ((self._by_start.get(uid), (start, end, key)), (self._by_end.get(uid), (end, start, key)),
+                            (self._short.get(uid), (start, end, key))):
+            i = bisect_left(items, item) if items else 0
+            if items and i < len(items) and items[i] == item:
+                items.pop(i)
+        if (start, end, key) in self._long.get(uid, ()):
+            self._long[uid].remove((start, end, key))
+
+    def overlapping(self, uid, start, end):
+        items = self._short.get(uid) or []
+        lo = bisect_left(items, start - self.long_after, key=itemgetter(0))
+        hi = bisect_left(items, end, key=itemgetter(0))
+        found = [it for it in items[lo:hi] if it[1] > start]
+        found.extend(it for it in self._long.get(uid, ()) if it[0] < end and it[1] > start)
+        return found
+
+    def overlaps(self, uid, start, end, exclude=None):
+        return any(it[2] != exclude for it in self.overlapping(uid, start, end))
+
+    def last_before(self, uid, t, exclude=None):
+        # האינטרוול שמסתיים הכי מאוחר עד t (כולל) -> (start, end, key)
+        items = self._by_end.get(uid) or []
+        i = bisect_right(items, t, key=itemgetter(0))
+        while i > 0:
+            i -= 1
+            if items[i][2] != exclude: return (items[i][1], items[i][0], items[i][2])
+        return None
+
+    def first_after(self, uid, t, exclude=None):
+        # האינטרוול הראשון שמתחיל מ-t והלאה -> (start, end, key)
+        items = self._by_start.get(uid) or []
+        for i in range(bisect_left(items, t, key=itemgetter(0)), len(items)):
+            if items[i][2] != exclude: return items[i]
+        return None
+
+def journal_changes(db_session, old_values, shifts, source, reverts_op_id=None, op_id=None):
+    # רושם ביומן רק משמרות שהערך שלהן באמת השתנה ביחס ל-old_values (נכתב יחד עם ה-commit של הפעולה)
+    return journal_values(db_session, old_values, {s.id: s.assigned_user_ids for s in shifts}, source, reverts_op_id, op_id)
+
+def journal_values(db_session, old_values, new_values, source, reverts_op_id=None, op_id=None):
+    # INSERT אחד (executemany) לכל הפעולה; ב-SQLite ה-ORM מכניס שורה-שורה כשהוא צריך את המזהים בחזרה
+    op_id = op_id or uuid4().hex
+    now = datetime.now()
+    rows = []
+    for shift_id, new in new_values.items():
+        old = old_values.get(shift_id) or ""
+        new = new or ""
+        if old != new:
+            rows.append({"op_id": op_id, "shift_id": shift_id, "old_user_ids": old, "new_user_ids": new,
+                         "source": source, "reverts_op_id": reverts_op_id, "created_at": now})
+    if rows: db_session.execute(insert(AssignmentJournal), rows)
+    return op_id
+
+def last_undoable_op(db_session):
+    # פעולה שאף אחת מהמשמרות שלה כבר לא מחזיקה את הערך שנרשם (נמחקה / שונתה מחוץ ליומן) אין מה לבטל -
+    # מדלגים עליה, אחרת היא הייתה חוזרת כ"אחרונה" לנצח ומסתירה את הפעולות שלפניה
+    reverted = select(AssignmentJournal.reverts_op_id).where(AssignmentJournal.reverts_op_id.isnot(None))
+    live = select(AssignmentJournal.op_id).join(Shift, Shift.id == AssignmentJournal.shift_id).where(
+        func.coalesce(Shift.assigned_user_ids, "") == func.coalesce(AssignmentJournal.new_user_ids, ""))
+    return db_session.query(AssignmentJournal).filter(
+        AssignmentJournal.source != "undo", AssignmentJournal.op_id.notin_(reverted), AssignmentJournal.op_id.in_(live)
+    ).order_by(AssignmentJournal.id.desc()).first()
+
+def undo_last_operation(db_session):
+    # מחזיר את המשמרות של הפעולה האחרונה לערך הקודם, מתוך שורות היומן בלבד.
+    # משמרת שהשתנתה מאז (ערך נוכחי שונה מהערך שנרשם) לא נדרסת.
+    last = last_undoable_op(db_session)
+    if not last: return None, 0, 0
+    rows = db_session.query(AssignmentJournal).filter(AssignmentJournal.op_id == last.op_id).all()
+    shifts = {s.id: s for s in db_session.query(Shift).filter(Shift.id.in_([r.shift_id for r in rows])).all()}
+    
+    old_values, reverted, skipped = {}, [], 0
+    for r in rows:
+        s = shifts.get(r.shift_id)
+        if s is None or (s.assigned_user_ids or "") != (r.new_user_ids or ""):
+            skipped += 1
+            continue
+        old_values[s.id] = s.assigned_user_ids
+        s.assigned_user_ids = r.old_user_ids
+        reverted.append(s)
+    journal_changes(db_session, old_values, reverted, "undo", reverts_op_id=last.op_id)
+    db_session.commit()
+    return last.source, len(reverted), skipped
+
+def assignment_diff_since(db_session, since_dt):
+    # "מה השתנה מאז": הערך הראשון (old) והאחרון (new) לכל משמרת, מתוך היומן בלבד
+    diff = {}
+    for r in db_session.query(AssignmentJournal).filter(AssignmentJournal.created_at >= since_dt).order_by(AssignmentJournal.id).all():
+        if r.shift_id not in diff: diff[r.shift_id] = [r.old_user_ids or "", r.new_user_ids or "", set()]
+        diff[r.shift_id][1] = r.new_user_ids or ""
+        diff[r.shift_id][2].add(r.source)
+    return {sid: (old, new, sources) for sid, (old, new, sources) in diff.items() if old != new}
+
+# --- מודל שיבוץ קומפקטי: רשומות מנותקות מה-ORM, זמנים בדקות מאז epoch ומזהים שלמים ---
+EPOCH = datetime(1970, 1, 1)
+
+def to_minutes(dt):
+    return int((dt - EPOCH).total_seconds() // 60)
+
+def from_minutes(m):
+    return EPOCH + timedelta(minutes=m)
+
+def is_black_minutes(start, end):
+    return 0 <= ((start + end) // 2) % 1440 // 60 < 6
+
+class ShiftRec:
+    __slots__ = ("id", "post_id", "start", "end", "required", "assigned", "is_black", "loaded")
+    def __init__(self, id, post_id, start_time, end_time, required, assigned_user_ids):
+        self.id, self.post_id, self.required = id, post_id, required
+        self.loaded = assigned_user_ids or ""
+        self.start, self.end = to_minutes(start_time), to_minutes(end_time)
+        self.assigned = [int(x) for x in (assigned_user_ids or "").split(",") if x]
+        self.is_black = is_black_minutes(self.start, self.end)
+
+class UserRec:
+    __slots__ = ("id", "name", "is_commander")
+    def __init__(self, id, name, is_commander):
+        self.id, self.name, self.is_commander = id, name, bool(is_commander)
+
+class PostRec:
+    __slots__ = ("id", "name", "requires_commander")
+    def __init__(self, id, name, requires_commander):
+        self.id, self.name, self.requires_commander = id, name, bool(requires_commander)
+
+def compile_pairing_rules(rules):
+    # חמ"ד -> אשכולות (union-find, טרנזיטיבי); הפרדת כוחות -> קבוצת התנגשות לכל חייל. הכל לפי מזהה שלם
+    parent = {}
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
     
-    # הבאת היסטוריה ועתיד כדי להמליץ נכון על מחליפים!
-    history_dt = start_dt - timedelta(hours=24)
-    lookahead_dt = end_dt + timedelta(hours=24)
-    all_recent_shifts = db_session.query(Shift).filter(Shift.start_time >= history_dt, Shift.start_time < lookahead_dt).all()
+    anti = {}
+    for u1, u2, rule_type in rules:
+        if rule_type == 'BUDDY':
+            parent[find(u1)] = find(u2)
+        elif rule_type == 'ANTI_BUDDY':
+            anti.setdefault(u1, set()).add(u2)
+            anti.setdefault(u2, set()).add(u1)
     
-    warnings = {}
-    posts_cache = {p.id: p for p in db_session.query(Post).all()}
-    users_cache = {u.id: u for u in db_session.query(User).all()}
-    pcs_cache = db_session.query(PostConstraint).all()
-    constraints_cache = db_session.query(Constraint).filter(Constraint.end_time >= start_dt).all()
+    clusters = {}
+    for uid in parent: clusters.setdefault(find(uid), []).append(uid)
+    buddies = {uid: tuple(sorted(members)) for members in clusters.values() if len(members) > 1 for uid in members}
+    return buddies, anti
+
+def load_schedule(db_session, start_dt, end_dt, with_stats=False, stats_from=None):
+    # נטען פעם אחת לכל הרצת מנוע, select של עמודות בלבד: משמרות מיממה לפני ועד יממה אחרי הטווח + אילוצים רלוונטיים.
+    # with_stats מוסיף את מה שמנוע השיבוץ צריך; stats_from מגביל את סטטיסטיקת הנטל לחלון (לתיקון מקומי)
+    users = [UserRec(*row) for row in db_session.query(User.id, User.name, User.is_commander).order_by(User.id).all()]
+    posts = {row[0]: PostRec(*row) for row in db_session.query(Post.id, Post.name, Post.requires_commander).all()}
+    
+    shifts = {row[0]: ShiftRec(*row) for row in db_session.query(
+        Shift.id, Shift.post_id, Shift.start_time, Shift.end_time, Shift.required_count, Shift.assigned_user_ids
+    ).filter(Shift.start_time >= start_dt - timedelta(hours=24), Shift.start_time < end_dt + timedelta(hours=24)).all()}
+    shift_index = IntervalIndex()
+    for s in shifts.values():
+        for uid in s.assigned: shift_index.add(uid, s.start, s.end, s.id)
+
+    constraint_index = IntervalIndex()
+    for c_id, c_uid, c_start, c_end in db_session.query(Constraint.id, Constraint.user_id, Constraint.start_time, Constraint.end_time).filter(Constraint.end_time >= start_dt).all():
+        constraint_index.add(c_uid, to_minutes(c_start), to_minutes(c_end), c_id)
+    
+    ctx = {
+        "start": to_minutes(start_dt),
+        "end": to_minutes(end_dt),
+        "users": users,
+        "users_by_id": {u.id: u for u in users},
+        "posts": posts,
+        "blocked_posts": set(db_session.query(PostConstraint.user_id, PostConstraint.post_id).all()),
+        "shifts": shifts,
+        "shift_index": shift_index,
+        "constraint_index": constraint_index,
+        "dirty": set(),
+    }
+    if not with_stats: return ctx
+    
+    stats_q = db_session.query(Shift.start_time, Shift.end_time, Shift.assigned_user_ids).filter(Shift.assigned_user_ids != "")
+    if stats_from is not None:
+        stats_q = stats_q.filter(Shift.start_time >= stats_from, Shift.start_time < end_dt + timedelta(hours=24))
+    user_stats = {u.id: {"total": 0.0, "daily": 0.0, "black_shifts": 0} for u in users}
+    
+    for s_start, s_end, assigned in stats_q.all():
+        start, end = to_minutes(s_start), to_minutes(s_end)
+        duration = (end - start) / 60.0
+        is_today = ctx["start"] <= start < ctx["end"]
+        is_black = is_black_minutes(start, end)
+        
+        for uid in (assigned or "").split(","):
+            if uid and int(uid) in user_stats:
+                user_stats[int(uid)]["total"] += duration
+                if is_today: user_stats[int(uid)]["daily"] += duration
+                if is_black: user_stats[int(uid)]["black_shifts"] += 1
+    
+    ctx["user_stats"] = user_stats
+    ctx["buddies"], ctx["anti"] = compile_pairing_rules(
+        db_session.query(PairingRule.user1_id, PairingRule.user2_id, PairingRule.rule_type).all()
+    )
+    return ctx
+
+def write_back(db_session, ctx, source):
+    # רק התוצאות חוזרות דרך ה-ORM, ב-compare-and-set מול הערך שנטען ב-load_schedule: משמרת שמישהו
+    # שינה בינתיים (שמירה ידנית / ניקוי / ביטול בזמן משימת רקע) לא נדרסת. מחזיר את המשמרות שדולגו.
+    pending = {}
+    for sid in sorted(ctx["dirty"]):
+        new = ",".join(str(uid) for uid in ctx["shifts"][sid].assigned)
+        if new != ctx["shifts"][sid].loaded: pending[sid] = new
+    if not pending: return []
+    
+    # UPDATE אחד (executemany) ואז SELECT אחד לבדוק מה נכתב - מספר קבוע של פקודות בלי קשר לגודל השיבוץ
+    t = Shift.__table__
+    db_session.connection().execute(
+        t.update().where(t.c.id == bindparam("sid"), func.coalesce(t.c.assigned_user_ids, "") == bindparam("loaded")).values(assigned_user_ids=bindparam("new")),
+        [{"sid": sid, "loaded": ctx["shifts"][sid].loaded, "new": new} for sid, new in pending.items()])
+    current = dict(db_session.query(Shift.id, Shift.assigned_user_ids).filter(Shift.id.in_(list(pending))).all())
+    
+    skipped, old_values, new_values, hours_delta = [], {}, {}, {}
+    for sid, new in pending.items():
+        rec = ctx["shifts"][sid]
+        if (current.get(sid) or "") != new:
+            skipped.append(sid)
+            continue
+        old_values[sid], new_values[sid] = rec.loaded, new
+        
+        duration = (rec.end - rec.start) / 60.0
+        old_ids, new_ids = {int(x) for x in rec.loaded.split(",") if x}, set(rec.assigned)
+        for uid in new_ids - old_ids: hours_delta[uid] = hours_delta.get(uid, 0.0) + duration
+        for uid in old_ids - new_ids: hours_delta[uid] = hours_delta.get(uid, 0.0) - duration
+    journal_values(db_session, old_values, new_values, source)
+    
+    if hours_delta:
+        for u in db_session.query(User).filter(User.id.in_(list(hours_delta))).all():
+            u.total_hours = max(0.0, (u.total_hours or 0.0) + hours_delta[u.id])
+    return skipped
 
+def shift_warnings(ctx, post_id=None):
+    # חישוב טהור על ctx שכבר נטען (כולל היסטוריה ועתיד כדי להמליץ נכון על מחליפים!) - בלי שאילתות,
+    # כך שהלוח מחשב התראות לכל עמודה מאותה טעינה
+    shift_index, constraint_index, blocked_posts = ctx["shift_index"], ctx["constraint_index"], ctx["blocked_posts"]
+    posts_cache, users_cache = ctx["posts"], ctx["users_by_id"]
+    shifts = [s for s in ctx["shifts"].values() if ctx["start"] <= s.start < ctx["end"] and (post_id is None or s.post_id == post_id)]
+    
+    warnings = {}
     for s in shifts:
-        assigned_ids_str = (s.assigned_user_ids or "").split(",")
-        assigned_ids = [int(x) for x in assigned_ids_str if x]
+        assigned_ids = s.assigned
         post_obj = posts_cache.get(s.post_id)
         
-        if len(assigned_ids) < s.required_count:
-            warnings[s.id] = f"בעמדת {post_obj.name if post_obj else s.post_id}: חסר שומר ({len(assigned_ids)}/{s.required_count})"
+        if len(assigned_ids) < s.required:
+            warnings[s.id] = f"בעמדת {post_obj.name if post_obj else s.post_id}: חסר שומר ({len(assigned_ids)}/{s.required})"
         
         if post_obj and post_obj.requires_commander and assigned_ids:
             if not any(users_cache[uid].is_commander for uid in assigned_ids if uid in users_cache):
@@ -223,44 +506,39 @@ def get_shift_warnings(db_session, target_date, days_to_add=1):
             u_obj = users_cache.get(uid)
             u_name = u_obj.name if u_obj else "שומר"
             
-            if any(pc.user_id == uid and pc.post_id == s.post_id for pc in pcs_cache):
+            if (uid, s.post_id) in blocked_posts:
                 warnings[s.id] = f"אילוץ לשומר {u_name}: אינו מורשה לשמור בעמדה זו"
             
-            if any(c.user_id == uid and c.start_time < s.end_time and c.end_time > s.start_time for c in constraints_cache):
+            if constraint_index.overlaps(uid, s.start, s.end):
                 warnings[s.id] = f"אילוץ לשומר {u_name}: חסום בשעות אלו"
             
-            prev_shifts = [os for os in all_recent_shifts if str(uid) in (os.assigned_user_ids or "").split(",") and os.end_time <= s.start_time and os.id != s.id]
-            prev_s = max(prev_shifts, key=lambda x: x.end_time, default=None)
+            prev = shift_index.last_before(uid, s.start, exclude=s.id)
+            prev_s = ctx["shifts"][prev[2]] if prev else None
             
             if prev_s:
-                rest = (s.start_time - prev_s.end_time).total_seconds() / 3600
+                rest = (s.start - prev_s.end) / 60
                 if rest < MIN_REST_HOURS:
                     prev_post_name = posts_cache[prev_s.post_id].name if prev_s.post_id in posts_cache else "לא ידוע"
-                    s_time = prev_s.start_time.strftime('%H:%M')
-                    e_time = prev_s.end_time.strftime('%H:%M')
+                    s_time = from_minutes(prev_s.start).strftime('%H:%M')
+                    e_time = from_minutes(prev_s.end).strftime('%H:%M')
                     
                     # --- מנוע מציאת המחליף האידיאלי (עם ראיית עתיד) ---
                     best_rep = None
                     max_rep_rest = -1
                     
                     for rep_u in users_cache.values():
-                        rep_uid_str = str(rep_u.id)
-                        if rep_uid_str in assigned_ids_str: continue 
-                        
-                        if any(pc.user_id == rep_u.id and pc.post_id == s.post_id for pc in pcs_cache): continue
-                        if any(c.user_id == rep_u.id and c.start_time < s.end_time and c.end_time > s.start_time for c in constraints_cache): continue
+                        if rep_u.id in assigned_ids: continue 
                         
-                        overlaps = any(str(rep_u.id) in (os.assigned_user_ids or "").split(",") and max(s.start_time, os.start_time) < min(s.end_time, os.end_time) for os in all_recent_shifts if os.id != s.id)
-                        if overlaps: continue
+                        if (rep_u.id, s.post_id) in blocked_posts: continue
+                        if constraint_index.overlaps(rep_u.id, s.start, s.end): continue
+                        if shift_index.overlaps(rep_u.id, s.start, s.end, exclude=s.id): continue
                         
-                        rep_prev_shifts = [os for os in all_recent_shifts if rep_uid_str in (os.assigned_user_ids or "").split(",") and os.end_time <= s.start_time]
-                        rep_last = max(rep_prev_shifts, key=lambda x: x.end_time, default=None)
-                        rep_rest = (s.start_time - rep_last.end_time).total_seconds() / 3600.0 if rep_last else 999
+                        rep_last = shift_index.last_before(rep_u.id, s.start)
+                        rep_rest = (s.start - rep_last[1]) / 60.0 if rep_last else 999
                         
                         # בדיקת עתיד: מוודאים שמשמרת ההחלפה לא דופקת לו את המשמרת הבאה
-                        rep_next_shifts = [os for os in all_recent_shifts if rep_uid_str in (os.assigned_user_ids or "").split(",") and os.start_time >= s.end_time]
-                        rep_next = min(rep_next_shifts, key=lambda x: x.start_time, default=None)
-                        future_rest = (rep_next.start_time - s.end_time).total_seconds() / 3600.0 if rep_next else 999
+                        rep_next = shift_index.first_after(rep_u.id, s.end)
+                        future_rest = (rep_next[0] - s.end) / 60.0 if rep_next else 999
                         
                         # ממליצים רק אם למחליף יש מספיק מנוחה גם לפני וגם אחרי המשמרת!
                         if rep_rest >= MIN_REST_HOURS and future_rest >= MIN_REST_HOURS:
@@ -279,103 +557,464 @@ def get_shift_warnings(db_session, target_date, days_to_add=1):
                         warnings[s.id] = f"חריגת מנוחה ל{u_name}: שמר קודם ב{prev_post_name} ({s_time}-{e_time}). נח {rest:.1f} ש' (אילוץ).{rec_str}"
     return warnings
 
-def auto_assign_shifts(db_session, target_date, days_to_add=1):
-    start_dt = datetime.combine(target_date, time(0,0))
-    end_dt = start_dt + timedelta(days=days_to_add) 
-    unassigned_shifts = db_session.query(Shift).filter(Shift.start_time >= start_dt, Shift.start_time < end_dt).order_by(Shift.start_time).all()
-    users = db_session.query(User).all()
-    posts = {p.id: p for p in db_session.query(Post).all()}
+def set_assigned(ctx, shift, uids):
+    # מחליף את השומרים במשמרת (למשל עריכה שעוד לא נשמרה) ומעדכן את האינדקס; מחזיר את הרשימה הקודמת לשחזור
+    old = shift.assigned
+    for uid in old: ctx["shift_index"].remove(uid, shift.start, shift.end, shift.id)
+    shift.assigned = list(uids)
+    for uid in shift.assigned: ctx["shift_index"].add(uid, shift.start, shift.end, shift.id)
+    return old
+
+def rest_around(ctx, uid, shift, look_ahead=False):
+    last_s = ctx["shift_index"].last_before(uid, shift.start, exclude=shift.id)
+    rest = (shift.start - last_s[1]) / 60.0 if last_s else 999
+    if look_ahead:
+        next_s = ctx["shift_index"].first_after(uid, shift.end, exclude=shift.id)
+        if next_s: rest = min(rest, (next_s[0] - shift.end) / 60.0)
+    return rest
+
+def rank_candidates(ctx, shift, look_ahead=False):
+    # מחזיר את המועמדים החוקיים למושב פנוי, ממוינים מהטוב לגרוע
+    users_by_id, user_stats, buddies = ctx["users_by_id"], ctx["user_stats"], ctx["buddies"]
+    assigned = shift.assigned
+    post_obj = ctx["posts"].get(shift.post_id)
+    req_cmd = post_obj.requires_commander if post_obj else False
     
-    all_shifts = db_session.query(Shift).filter(Shift.assigned_user_ids != "").all()
-    user_stats = {str(u.id): {"total": 0.0, "daily": 0.0, "black_shifts": 0} for u in users}
+    candidates = []
+    has_cmd = any(users_by_id[a].is_commander for a in assigned if a in users_by_id)
+    # נבנה פעם אחת למושב - בדיקת הפרדת כוחות וניקוד חמ"ד הם O(1) לכל מועמד
+    forbidden = set().union(*(ctx["anti"].get(a, ()) for a in assigned))
+    assigned_clusters = {}
+    for a in assigned:
+        if a in buddies: assigned_clusters[buddies[a]] = assigned_clusters.get(buddies[a], 0) + 1
     
-    for s in all_shifts:
-        duration = (s.end_time - s.start_time).total_seconds() / 3600.0
-        is_today = start_dt <= s.start_time < end_dt
-        is_black = is_black_shift(s.start_time, s.end_time)
+    for user in ctx["users"]:
+        if user.id in assigned: continue
+        if (user.id, shift.post_id) in ctx["blocked_posts"]: continue
         
-        for uid in (s.assigned_user_ids or "").split(","):
-            if uid in user_stats:
-                user_stats[uid]["total"] += duration
-                if is_today: user_stats[uid]["daily"] += duration
-                if is_black: user_stats[uid]["black_shifts"] += 1
-    
-    rules_dict = {
-        (str(r.user1_id), str(r.user2_id)): r.rule_type
-        for r in db_session.query(PairingRule).all()
-    }
-    rules_dict.update({(k[1], k[0]): v for k, v in rules_dict.items()}) 
+        if ctx["shift_index"].overlaps(user.id, shift.start, shift.end, exclude=shift.id): continue
+        if ctx["constraint_index"].overlaps(user.id, shift.start, shift.end): continue
+
+        if user.id in forbidden: continue
         
-    blocked_posts = {(pc.user_id, pc.post_id) for pc in db_session.query(PostConstraint).all()}
-    
-    for shift in unassigned_shifts:
-        assigned_list = [x for x in (shift.assigned_user_ids or "").split(",") if x]
-        needed = shift.required_count - len(assigned_list)
-        post_obj = posts.get(shift.post_id)
-        req_cmd = post_obj.requires_commander if post_obj else False
-        current_is_black = is_black_shift(shift.start_time, shift.end_time)
+        buddy_score = assigned_clusters.get(buddies[user.id], 0) if user.id in buddies else 0
+
+        rest = rest_around(ctx, user.id, shift, look_ahead)
         
-        for _ in range(needed):
-            db_session.flush()
-            candidates = []
-            has_cmd = any(next((u.is_commander for u in users if str(u.id) == a), False) for a in assigned_list)
-            
-            for user in users:
-                uid_str = str(user.id)
-                if uid_str in assigned_list: continue
-                if (user.id, shift.post_id) in blocked_posts: continue
-                
-                u_s = [s for s in db_session.query(Shift).filter(Shift.start_time >= start_dt - timedelta(hours=24)).all() if str(user.id) in (s.assigned_user_ids or "").split(",")]
-                if any(max(shift.start_time, s.start_time) < min(shift.end_time, s.end_time) for s in u_s if s.id != shift.id): continue
-                if db_session.query(Constraint).filter(Constraint.user_id == user.id, Constraint.start_time < shift.end_time, Constraint.end_time > shift.start_time).first(): continue
+        cmd_priority = 1 if (req_cmd and not has_cmd and user.is_commander) else 0
+        
+        candidates.append({
+            "user": user, 
+            "total": user_stats[user.id]["total"], 
+            "daily": user_stats[user.id]["daily"], 
+            "rest": rest, 
+            "buddy_score": buddy_score, 
+            "cmd_priority": cmd_priority,
+            "black_shifts": user_stats[user.id]["black_shifts"]
+        })
+    
+    candidates.sort(key=lambda c: (
+        c["rest"] < MIN_REST_HOURS, 
+        -c["cmd_priority"], 
+        -c["buddy_score"], 
+        c["black_shifts"] if shift.is_black else 0, 
+        c["daily"], 
+        c["total"], 
+        -c["rest"]
+    ))
+    return candidates
 
-                is_anti_buddy = any(rules_dict.get((uid_str, a_uid)) == 'ANTI_BUDDY' for a_uid in assigned_list)
-                if is_anti_buddy: continue
-                
-                buddy_score = sum(1 for a_uid in assigned_list if rules_dict.get((uid_str, a_uid)) == 'BUDDY')
+def pick_unit(ctx, shift, candidates):
+    # חמ"ד כיחידה: מועמד מאשכול נכנס רק יחד עם כל השותפים שלו, אם יש להם מקום ואין מניעה
+    # (אשכול גדול מהעמדה - עם כמה שותפים שנכנסים, לפי סדר הדירוג).
+    # מועמד שהאשכול שלו לא נכנס נדחה לטובת הבא בתור - רק בתוך אותה שכבת מנוחה: אם הבא בתור לא נח,
+    # משבצים את המועמד הנח לבד (כמו כל חייל אחר) ולא מוותרים עליו לטובת חריגת מנוחה.
+    free = shift.required - len(shift.assigned)
+    valid = {c["user"].id: c for c in candidates}
+    users_by_id = ctx["users_by_id"]
+    post_obj = ctx["posts"].get(shift.post_id)
+    needs_cmd = bool(post_obj and post_obj.requires_commander) and not any(users_by_id[a].is_commander for a in shift.assigned if a in users_by_id)
+    
+    deferred = None
+    for c in candidates:
+        uid = c["user"].id
+        if deferred and (c["rest"] < MIN_REST_HOURS) != (deferred["rest"] < MIN_REST_HOURS): return [deferred["user"].id]
+        cluster = ctx["buddies"].get(uid)
+        if cluster is None: return [uid]
+        
+        mates = [m for m in cluster if m != uid and m not in shift.assigned]
+        mate_ok = lambda m: m in valid and not (valid[m]["rest"] < MIN_REST_HOURS <= c["rest"])
+        if len(cluster) > shift.required:
+            mates = [m["user"].id for m in candidates if m["user"].id in mates and mate_ok(m["user"].id)][:free - 1]
+        unit = [uid] + mates
+        if (len(unit) <= free and all(mate_ok(m) for m in mates)
+                and not any(m2 in ctx["anti"].get(m, ()) for m in unit for m2 in unit)
+                and not (needs_cmd and len(unit) == free and not any(users_by_id[m].is_commander for m in unit))):
+            return unit
+        deferred = deferred or c
+    return [candidates[0]["user"].id]
 
-                last_s = max([s for s in u_s if s.end_time <= shift.start_time], key=lambda x: x.end_time, default=None)
-                rest = (shift.start_time - last_s.end_time).total_seconds() / 3600.0 if last_s else 999
-                
-                cmd_priority = 1 if (req_cmd and not has_cmd and user.is_commander) else 0
-                
-                candidates.append({
-                    "user": user, 
-                    "total": user_stats[uid_str]["total"], 
-                    "daily": user_stats[uid_str]["daily"], 
-                    "rest": rest, 
-                    "buddy_score": buddy_score, 
-                    "cmd_priority": cmd_priority,
-                    "black_shifts": user_stats[uid_str]["black_shifts"]
-                })
+def assign_user(ctx, shift, uid):
+    shift.assigned.append(uid)
+    
+    duration = (shift.end - shift.start) / 60.0
+    ctx["user_stats"][uid]["total"] += duration
+    ctx["user_stats"][uid]["daily"] += duration
+    if shift.is_black: ctx["user_stats"][uid]["black_shifts"] += 1
+    ctx["dirty"].add(shift.id)
+    ctx["shift_index"].add(uid, shift.start, shift.end, shift.id)
+
+def unassign_user(ctx, shift, uid):
+    shift.assigned.remove(uid)
+    
+    duration = (shift.end - shift.start) / 60.0
+    ctx["user_stats"][uid]["total"] -= duration
+    ctx["user_stats"][uid]["daily"] -= duration
+    if shift.is_black: ctx["user_stats"][uid]["black_shifts"] -= 1
+    ctx["dirty"].add(shift.id)
+    ctx["shift_index"].remove(uid, shift.start, shift.end, shift.id)
+
+def auto_assign_shifts(db_session, target_date, days_to_add=1, progress=None):
+    start_dt = datetime.combine(target_date, time(0,0))
+    end_dt = start_dt + timedelta(days=days_to_add) 
+    ctx = load_schedule(db_session, start_dt, end_dt, with_stats=True)
+    unassigned_shifts = sorted((s for s in ctx["shifts"].values() if ctx["start"] <= s.start < ctx["end"]), key=lambda s: (s.start, s.id))
+    
+    for i, shift in enumerate(unassigned_shifts):
+        if progress: progress(i / len(unassigned_shifts), f"משבץ {from_minutes(shift.start).strftime('%d/%m %H:%M')}")
+        
+        while len(shift.assigned) < shift.required:
+            candidates = rank_candidates(ctx, shift)
+            if not candidates: break
+            for uid in pick_unit(ctx, shift, candidates):
+                assign_user(ctx, shift, uid)
+    skipped = write_back(db_session, ctx, "auto")
+    db_session.commit()
+    return skipped
+
+def _seat_ok(ctx, shift, cand):
+    # מושב שמולא בתיקון מקומי לא יוצר חריגה חדשה: מנוחה מלאה, ומפקד אם העמדה דורשת
+    post_obj = ctx["posts"].get(shift.post_id)
+    if cand["rest"] < MIN_REST_HOURS: return False
+    if not (post_obj and post_obj.requires_commander) or cand["user"].is_commander: return True
+    return any(ctx["users_by_id"][a].is_commander for a in shift.assigned if a in ctx["users_by_id"])
+
+def _swap_into(ctx, shift, candidates):
+    # חיפוש מקומי בעומק 1: מועמד שחסרה לו מנוחה רק בגלל משמרת שכנה עובר למושב הפנוי,
+    # ובמשמרת השכנה נכנס במקומו חייל נח. אם אין החלפה כזו - לא נוגעים בכלום.
+    now = to_minutes(datetime.now())
+    for cand in candidates:
+        uid = cand["user"].id
+        for nb in (ctx["shift_index"].last_before(uid, shift.start, exclude=shift.id),
+                   ctx["shift_index"].first_after(uid, shift.end, exclude=shift.id)):
+            t = ctx["shifts"].get(nb[2]) if nb else None
+            if t is None or t.start < now: continue
             
-            if candidates:
-                candidates.sort(key=lambda c: (
-                    c["rest"] < MIN_REST_HOURS, 
-                    -c["cmd_priority"], 
-                    -c["buddy_score"], 
-                    c["black_shifts"] if current_is_black else 0, 
-                    c["daily"], 
-                    c["total"], 
-                    -c["rest"]
-                ))
-                best = candidates[0]["user"]
-                best_uid = str(best.id)
-                
-                assigned_list.append(best_uid)
-                if best.is_commander: has_cmd = True 
-                
-                duration = (shift.end_time - shift.start_time).total_seconds() / 3600.0
-                user_stats[best_uid]["total"] += duration
-                user_stats[best_uid]["daily"] += duration
-                if current_is_black: user_stats[best_uid]["black_shifts"] += 1
-                best.total_hours += duration
-                shift.assigned_user_ids = ",".join(assigned_list)
+            t_orig = list(t.assigned)
+            unassign_user(ctx, t, uid)
+            if _seat_ok(ctx, shift, dict(cand, rest=rest_around(ctx, uid, shift, look_ahead=True))):
+                assign_user(ctx, shift, uid)
+                t_best = next((c for c in rank_candidates(ctx, t, look_ahead=True) if _seat_ok(ctx, t, c)), None)
+                if t_best:
+                    assign_user(ctx, t, t_best["user"].id)
+                    return [(shift, None, uid), (t, uid, t_best["user"].id)]
+                unassign_user(ctx, shift, uid)
+            assign_user(ctx, t, uid)
+            t.assigned[:] = t_orig
+    return None
+
+def repair_assignments(db_session, constraints=(), post_constraints=()):
+    # תיקון מקומי אחרי אילוץ חדש: משחררים רק את המושבים שמתנגשים בו וממלאים אותם מחדש,
+    # בלי לגעת בשאר הלוח. מחזיר רשימת שינויים (משמרת, חייל שיצא, חייל שנכנס).
+    # משמרות שכבר הסתיימו הן היסטוריה - לא משחררים ולא ממלאים אותן מחדש
+    conflicts = []
+    now = datetime.now()
+    cols = (Shift.id, Shift.start_time, Shift.end_time, Shift.assigned_user_ids)
+    for c in constraints:
+        for row in db_session.query(*cols).filter(Shift.start_time < c.end_time, Shift.end_time > c.start_time, Shift.end_time > now).all():
+            if str(c.user_id) in (row[3] or "").split(","): conflicts.append((row, c.user_id))
+    
+    for pc in post_constraints:
+        for row in db_session.query(*cols).filter(Shift.post_id == pc.post_id, Shift.end_time > now, Shift.assigned_user_ids.like(f"%{pc.user_id}%")).all():
+            if str(pc.user_id) in (row[3] or "").split(","): conflicts.append((row, pc.user_id))
+    
+    if not conflicts: return []
+    
+    start_dt = min(row[1] for row, _ in conflicts)
+    end_dt = max(row[2] for row, _ in conflicts)
+    ctx = load_schedule(db_session, start_dt, end_dt, with_stats=True, stats_from=start_dt - timedelta(hours=24))
+    
+    freed = []
+    for row, uid in conflicts:
+        s = ctx["shifts"][row[0]]
+        if uid not in s.assigned or uid not in ctx["users_by_id"]: continue
+        unassign_user(ctx, s, uid)
+        freed.append((s, uid))
+    
+    changes = []
+    for s, uid in sorted(freed, key=lambda x: x[0].start):
+        candidates = rank_candidates(ctx, s, look_ahead=True)
+        best = next((c for c in candidates if _seat_ok(ctx, s, c)), None)
+        
+        if best:
+            assign_user(ctx, s, best["user"].id)
+            changes.append((s, uid, best["user"].id))
+            continue
+        
+        swap = _swap_into(ctx, s, candidates)
+        if swap:
+            changes.append((s, uid, swap[0][2]))
+            changes.extend(swap[1:])
+        elif candidates:
+            assign_user(ctx, s, candidates[0]["user"].id)
+            changes.append((s, uid, candidates[0]["user"].id))
+        else:
+            changes.append((s, uid, None))
+    skipped = set(write_back(db_session, ctx, "repair"))
     db_session.commit()
+    return [c for c in changes if c[0].id not in skipped]
+
+def describe_repair(db_session, changes):
+    names = dict(db_session.query(User.id, User.name).all())
+    posts = dict(db_session.query(Post.id, Post.name).all())
+    return [{
+        "עמדה": posts.get(s.post_id, s.post_id),
+        "משמרת": f"{from_minutes(s.start).strftime('%d/%m %H:%M')} - {from_minutes(s.end).strftime('%H:%M')}",
+        "יצא": names.get(old_uid, "—") if old_uid else "—",
+        "נכנס": names.get(new_uid, "— פנוי —") if new_uid else "— פנוי —",
+    } for s, old_uid, new_uid in changes]
+
+def _time_mask(t_from, t_to, minute_of_day):
+    # גרסה וקטורית של is_time_in_range על מערך דקות-ביום
+    if t_from is None or t_to is None: return np.zeros(minute_of_day.shape, dtype=bool)
+    s, e = t_from.hour * 60 + t_from.minute, t_to.hour * 60 + t_to.minute
+    if s <= e: return (minute_of_day >= s) & (minute_of_day <= e)
+    return (minute_of_day >= s) | (minute_of_day <= e)
+
+def compute_coverage(db_session, start_date, days=7):
+    # כיסוי מול זמינות לכל שעה בטווח, במעבר וקטורי אחד (NumPy) על כל השבוע:
+    # נדרש = שומרי בסיס + תגבור לכל עמדה פעילה; זמין = חיילים בלי אילוץ, שלא במנוחה ממשמרת שלפני הטווח,
+    # ושיש להם לפחות עמדה פעילה אחת שאינה חסומה להם; יכולת = זמינים * אורך משמרת / (אורך משמרת + מנוחה).
+    # שיבוצים בתוך הטווח לא נספרים - הסבב עצמו כבר מגולם ביכולת.
+    start_dt = datetime.combine(start_date, time(0,0))
+    end_dt = start_dt + timedelta(days=days)
+    bins = to_minutes(start_dt) + 60 * np.arange(days * 24)
+    bin_ends = bins + 60
+    minute_of_day = bins % 1440
+    
+    user_ids = np.array([uid for uid, in db_session.query(User.id).order_by(User.id).all()], dtype=np.int64)
+    posts = db_session.query(Post.id, Post.shift_length_minutes, Post.required_guards, Post.active_from, Post.active_to,
+                             Post.boost_from, Post.boost_to, Post.boost_guards).order_by(Post.id).all()
+    
+    # נדרש: P x H
+    required = np.zeros((len(posts), len(bins)), dtype=np.int64)
+    for i, (_, _, base_g, a_from, a_to, b_from, b_to, b_extra) in enumerate(posts):
+        active = _time_mask(a_from, a_to, minute_of_day)
+        boost = _time_mask(b_from, b_to, minute_of_day) if (b_extra or 0) > 0 else np.zeros(len(bins), dtype=bool)
+        required[i] = active * ((base_g or 0) + boost * (b_extra or 0))
+    active_posts = required > 0
+    
+    busy = np.zeros((len(user_ids), len(bins)), dtype=bool)
+    if len(user_ids):
+        u_pos = {uid: i for i, uid in enumerate(user_ids)}
+        
+        # אילוצים: C x H חפיפה בשידור (broadcast), מקובץ לחיילים
+        c_rows = db_session.query(Constraint.user_id, Constraint.start_time, Constraint.end_time).filter(Constraint.end_time > start_dt, Constraint.start_time < end_dt).all()
+        c_rows = [r for r in c_rows if r[0] in u_pos]
+        if c_rows:
+            c_u = np.array([u_pos[r[0]] for r in c_rows])
+            c_s = np.array([to_minutes(r[1]) for r in c_rows])[:, None]
+            c_e = np.array([to_minutes(r[2]) for r in c_rows])[:, None]
+            np.logical_or.at(busy, c_u, (c_s < bin_ends) & (c_e > bins))
+        
+        # מנוחה: משמרות שהתחילו לפני הטווח תופסות את החייל עד סופן + MIN_REST_HOURS
+        a_rows = db_session.query(Shift.start_time, Shift.end_time, Shift.assigned_user_ids).filter(Shift.assigned_user_ids != "", Shift.start_time < start_dt, Shift.end_time > start_dt - timedelta(hours=MIN_REST_HOURS)).all()
+        r_u, r_s, r_e = [], [], []
+        for a_start, a_end, assigned in a_rows:
+            for uid in (assigned or "").split(","):
+                if uid and int(uid) in u_pos:
+                    r_u.append(u_pos[int(uid)])
+                    r_s.append(to_minutes(a_start))
+                    r_e.append(to_minutes(a_end) + MIN_REST_HOURS * 60)
+        if r_u:
+            r_s, r_e = np.array(r_s)[:, None], np.array(r_e)[:, None]
+            np.logical_or.at(busy, np.array(r_u), (r_s < bin_ends) & (r_e > bins))
+        
+        # חסימות עמדה: U x P, ומכפלה מול העמדות הפעילות בכל שעה
+        allowed = np.ones((len(user_ids), len(posts)), dtype=np.int64)
+        p_pos = {p[0]: i for i, p in enumerate(posts)}
+        for uid, pid in db_session.query(PostConstraint.user_id, PostConstraint.post_id).all():
+            if uid in u_pos and pid in p_pos: allowed[u_pos[uid], p_pos[pid]] = 0
+        can_serve = (allowed @ active_posts.astype(np.int64)) > 0
+        available = (~busy & can_serve).sum(axis=0)
+    else:
+        available = np.zeros(len(bins), dtype=np.int64)
+    
+    # אורך משמרת ממוצע (משוקלל בשומרים) של העמדות הפעילות בכל שעה
+    lengths = np.array([p[1] or 120 for p in posts], dtype=float)[:, None]
+    req_total = required.sum(axis=0)
+    avg_len = np.divide((required * lengths).sum(axis=0), req_total, out=np.full(len(bins), 120.0), where=req_total > 0)
+    capacity = available * avg_len / (avg_len + MIN_REST_HOURS * 60)
+    
+    return pd.DataFrame({
+        "time": pd.to_datetime(start_dt) + pd.to_timedelta(60 * np.arange(len(bins)), unit="m"),
+        "required": req_total,
+        "available": available,
+        "capacity": capacity.round(1),
+        "margin": (capacity - req_total).round(1),
+    })
 
 # דגל למנגנון הריענון החי
 def flag_save():
     st.session_state.save_clicked = True
+    # כל עמודות העמדות נשמרות תחת אותה פעולה ביומן (לביטול בלחיצה אחת)
+    st.session_state.save_op_id = uuid4().hex
+
+def generate_empty_slots(db_session, g_date, days=1, progress=None):
+    posts = db_session.query(Post).all()
+    start_g = datetime.combine(g_date, time(0,0))
+    end_g = start_g + timedelta(days=days)
+    # שאילתה אחת לסלוטים הקיימים במקום שאילתה לכל סלוט (וגם לא נועלים את המסד באמצע הריצה)
+    existing = set(db_session.query(Shift.post_id, Shift.start_time).filter(Shift.start_time >= start_g, Shift.start_time < end_g).all())
+    for i, p in enumerate(posts):
+        if progress: progress(i / len(posts), f"מייצר סלוטים ל{p.name}")
+        curr = start_g
+        while curr < end_g:
+            if is_time_in_range(p.active_from, p.active_to, curr.time()):
+                req = p.required_guards
+                if p.boost_guards > 0 and is_time_in_range(p.boost_from, p.boost_to, curr.time()):
+                    req += p.boost_guards
+                if (p.id, curr) not in existing:
+                    db_session.add(Shift(post_id=p.id, start_time=curr, 
+                                       end_time=curr + timedelta(minutes=p.shift_length_minutes),
+                                       required_count=req))
+            curr += timedelta(minutes=p.shift_length_minutes)
+    db_session.commit()
+
+# ==========================================
+# 2.5. משימות רקע (שיבוץ אוטומטי / ייצור סלוטים)
+# ==========================================
+ACTIVE_JOB_STATUSES = ("PENDING", "RUNNING")
+JOB_TITLES = {"auto_assign": "🤖 שיבוץ אוטומטי", "generate_slots": "📅 ייצור סלוטים"}
+
+class JobCancelled(Exception):
+    pass
+
+@st.cache_resource
+def get_job_runner():
+    # Pool אחד לכל התהליך. משימות שנשארו "רצות" מהפעלה קודמת של השרת מסומנות ככושלות
+    with SessionLocal() as db_session:
+        for job in db_session.query(Job).filter(Job.status.in_(ACTIVE_JOB_STATUSES)).all():
+            job.status, job.message, job.finished_at = "FAILED", "הופסק - השרת הופעל מחדש", datetime.now()
+        db_session.commit()
+    return {"pool": ThreadPoolExecutor(max_workers=2), "lock": threading.Lock()}
+
+def _job_progress(job_id):
+    last_pct = [-1]
+    def progress(fraction, message=""):
+        pct = int(fraction * 100)
+        if pct == last_pct[0]: return
+        last_pct[0] = pct
+        # סשן נפרד וקצר - העבודה עצמה נשמרת רק ב-commit אחד בסוף
+        with SessionLocal() as status_session:
+            job = status_session.get(Job, job_id)
+            if job.cancel_requested: raise JobCancelled()
+            job.progress, job.message = fraction, message
+            status_session.commit()
+    return progress
+
+def _run_job(job_id):
+    with SessionLocal() as status_session:
+        job = status_session.get(Job, job_id)
+        kind, params = job.kind, json.loads(job.params or "{}")
+        job.status = "RUNNING"
+        status_session.commit()
+    
+    db_session = SessionLocal()
+    try:
+        status, message = "DONE", "הושלם"
+        if kind == "auto_assign":
+            skipped = auto_assign_shifts(db_session, date.fromisoformat(params["date"]), params["days"], progress=_job_progress(job_id))
+            if skipped: message = f"הושלם ({len(skipped)} משמרות ששונו ידנית בזמן הריצה לא נדרסו)"
+        elif kind == "generate_slots":
+            generate_empty_slots(db_session, date.fromisoformat(params["date"]), params["days"], progress=_job_progress(job_id))
+    except JobCancelled:
+        db_session.rollback()
+        status, message = "CANCELLED", "בוטל - הלוח לא השתנה"
+    except Exception as e:
+        db_session.rollback()
+        status, message = "FAILED", str(e)
+    finally:
+        db_session.close()
+    
+    with SessionLocal() as status_session:
+        job = status_session.get(Job, job_id)
+        job.status, job.message, job.finished_at = status, message, datetime.now()
+        if status == "DONE": job.progress = 1.0
+        status_session.commit()
+
+def start_job(db_session, kind, params):
+    # מחזיר (job_id, נוצרה_חדשה). אם כבר רצה משימה מאותו סוג - לא מתחילים כפילות
+    runner = get_job_runner()
+    with runner["lock"]:
+        running = db_session.query(Job).filter(Job.kind == kind, Job.status.in_(ACTIVE_JOB_STATUSES)).first()
+        if running: return running.id, False
+        job = Job(kind=kind, params=json.dumps(params))
+        db_session.add(job)
+        db_session.commit()
+    runner["pool"].submit(_run_job, job.id)
+    return job.id, True
+
+def cancel_job(job_id):
+    with SessionLocal() as db_session:
+        job = db_session.get(Job, job_id)
+        if job and job.status in ACTIVE_JOB_STATUSES:
+            job.cancel_requested = True
+            db_session.commit()
+
+@st.fragment(run_every=1)
+def render_active_jobs():
+    with SessionLocal() as db_session:
+        watched = st.session_state.setdefault("watched_jobs", [])
+        jobs = db_session.query(Job).filter(Job.id.in_(watched)).all() if watched else []
+        done = [j for j in jobs if j.status not in ACTIVE_JOB_STATUSES]
+        for job in jobs:
+            if job in done: continue
+            c_prog, c_cancel = st.columns([4, 1])
+            c_prog.progress(min(job.progress or 0.0, 1.0), text=f"{JOB_TITLES.get(job.kind, job.kind)}: {job.message or 'ממתין...'}")
+            if job.cancel_requested:
+                c_cancel.caption("מבטל...")
+            elif c_cancel.button("✖️ ביטול", key=f"cancel_job_{job.id}"):
+                cancel_job(job.id)
+        if done:
+            st.session_state.watched_jobs = [j.id for j in jobs if j not in done]
+            st.session_state.finished_jobs = [(j.kind, j.status, j.message) for j in done]
+            st.rerun()
+
+def render_jobs_panel(db_session):
+    for kind, status, message in st.session_state.pop("finished_jobs", []):
+        title = JOB_TITLES.get(kind, kind)
+        if status == "DONE": st.success(f"{title} הושלם!" if message == "הושלם" else f"{title}: {message}")
+        elif status == "CANCELLED": st.info(f"{title}: {message}")
+        else: st.error(f"{title} נכשל: {message}")
+    
+    # משימות שרצות כרגע (גם כאלה שהתחילו מחלון אחר) - מציגים ועוקבים עד הסיום
+    active = [j.id for j in db_session.query(Job.id).filter(Job.status.in_(ACTIVE_JOB_STATUSES)).all()]
+    watched = st.session_state.setdefault("watched_jobs", [])
+    st.session_state.watched_jobs = watched + [j for j in active if j not in watched]
+    if st.session_state.watched_jobs:
+        render_active_jobs()
+
+# תוצאות תיקון מקומי אחרי אילוץ חדש - מוצג פעם אחת אחרי הריענון
+def render_repair_diff():
+    diff = st.session_state.pop("repair_diff", None)
+    if diff is None: return
+    if not diff:
+        st.info("🩹 האילוץ לא התנגש באף משמרת משובצת - הלוח לא השתנה.")
+        return
+    st.warning(f"🩹 תיקון מקומי: {len(diff)} שינויים בלוח (שאר הלוח לא נגע)")
+    df_diff = pd.DataFrame(diff).iloc[:, ::-1]
+    st.table(df_diff.style.set_properties(**{'text-align': 'right'}))
 
 # ==========================================
 # 3. טאב דשבורד
@@ -390,7 +1029,7 @@ def render_dashboard_tab(db_session):
 
     tools_container = st.container()
     with tools_container:
-        col_date, col_auto, col_clear, col_save = st.columns([1.5, 1.2, 1, 1])
+        col_date, col_auto, col_clear, col_undo, col_save = st.columns([1.5, 1.2, 1, 1, 1])
         with col_date:
             selected_date = st.date_input("תאריך התחלה:", date.today())
             view_mode = st.radio("תצוגת לוח:", ["24 שעות", "48 שעות"], horizontal=True, label_visibility="collapsed")
@@ -398,20 +1037,32 @@ def render_dashboard_tab(db_session):
         with col_auto:
             st.write("") 
             if st.button("🤖 שיבוץ אוטומטי חכם", type="primary", use_container_width=True):
-                auto_assign_shifts(db_session, selected_date, days_to_show)
-                st.success("השיבוץ הושלם!")
-                st.rerun()
+                _, created = start_job(db_session, "auto_assign", {"date": selected_date.isoformat(), "days": days_to_show})
+                # rerun רק כשנוצרה משימה חדשה - אחרת האזהרה הייתה נמחקת לפני שהמשתמש רואה אותה
+                if created: st.rerun()
+                st.warning("שיבוץ אוטומטי כבר רץ ברקע - ממתינים לסיומו.")
         with col_clear:
             st.write("") 
             if st.button("🧹 נקה לוח ידנית", use_container_width=True):
                 s_clear = datetime.combine(selected_date, time(0,0))
                 e_clear = s_clear + timedelta(days=days_to_show)
                 shifts_to_clear = db_session.query(Shift).filter(Shift.start_time >= s_clear, Shift.start_time < e_clear).all()
+                old_values = {s.id: s.assigned_user_ids for s in shifts_to_clear}
                 for s in shifts_to_clear:
                     s.assigned_user_ids = ""
+                journal_changes(db_session, old_values, shifts_to_clear, "clear")
                 db_session.commit()
                 st.success("הלוח נוקה!")
                 st.rerun()
+        with col_undo:
+            st.write("") 
+            if st.button("↩️ בטל פעולה אחרונה", use_container_width=True):
+                source, n_reverted, n_skipped = undo_last_operation(db_session)
+                if source is None:
+                    st.toast("אין פעולה לביטול ביומן.")
+                else:
+                    st.toast(f"בוטלה פעולת '{JOURNAL_SOURCES.get(source, source)}': {n_reverted} משמרות שוחזרו" + (f", {n_skipped} השתנו מאז ולא נדרסו" if n_skipped else ""))
+                st.rerun()
         with col_save:
             st.write("") 
             st.button("💾 שמור שינויים ידניים", type="primary", use_container_width=True, on_click=flag_save)
@@ -421,73 +1072,133 @@ def render_dashboard_tab(db_session):
     time_setting = db_session.query(SystemSetting).filter_by(key="time_display").first()
     time_format_full = True if not time_setting or time_setting.value == "full" else False
 
-    users = db_session.query(User).all()
-    posts = db_session.query(Post).all()
-    id_to_name = {str(u.id): f"{u.name} ⭐" if u.is_commander else u.name for u in users}
-    name_to_id = {f"{u.name} ⭐" if u.is_commander else u.name: str(u.id) for u in users}
+    # טעינה אחת של הלוח לכל הרצה מלאה; העמודות מקבלות אותה כארגומנט ו-Streamlit שומר אותה גם להרצות של fragment בודד
+    start_view = datetime.combine(selected_date, time(0,0))
+    ctx = load_schedule(db_session, start_view, start_view + timedelta(days=days_to_show))
+    id_to_name = {str(u.id): f"{u.name} ⭐" if u.is_commander else u.name for u in ctx["users"]}
+    posts = sorted(ctx["posts"].values(), key=lambda p: p.id)
     
     if not posts:
-        st.info("נא להגדיר עמדות בטאב 'הגדרות'.")
+        st.info("נא להגדיר עמדות בעמוד 'הגדרות'.")
         return
 
-    start_view = datetime.combine(selected_date, time(0,0))
-    end_view = start_view + timedelta(days=days_to_show) 
-    
-    warnings_dict = get_shift_warnings(db_session, selected_date, days_to_show)
     post_cols = st.columns(len(posts))
-    
     for i, post in enumerate(posts):
         with post_cols[i]:
-            st.markdown(f'<div class="post-header">{post.name} {"(👮‍♂️)" if post.requires_commander else ""}</div>', unsafe_allow_html=True)
-            p_shifts = db_session.query(Shift).filter(Shift.post_id == post.id, Shift.start_time >= start_view, Shift.start_time < end_view).order_by(Shift.start_time).all()
-            
-            if not p_shifts:
-                st.caption("אין משמרות בטווח הזמן הזה.")
-                continue
-
-            data = []
-            max_g = max([s.required_count for s in p_shifts])
-            
-            for s in p_shifts:
-                err_mark = "🛑 " if s.id in warnings_dict else ""
-                assigned = (s.assigned_user_ids or "").split(",")
-                
-                s_f = s.start_time.strftime('%d/%m %H:%M') if days_to_show == 2 else s.start_time.strftime('%H:%M')
-                e_f = s.end_time.strftime('%H:%M')
-                t_str = f"{s_f} - {e_f}" if time_format_full else s_f
-                
-                row = {"ID": s.id, "זמן": f"{err_mark}{t_str}"}
-                for j in range(max_g):
-                    row[f"שומר {j+1}"] = id_to_name.get(assigned[j] if j < len(assigned) else "", "-- פנוי --")
-                data.append(row)
-            
-            df = pd.DataFrame(data)
-            df = df.iloc[:, ::-1] 
-            config = {"ID": None, "זמן": st.column_config.TextColumn(disabled=True)}
-            for j in range(max_g):
-                config[f"שומר {j+1}"] = st.column_config.SelectboxColumn(options=["-- פנוי --"] + list(name_to_id.keys()))
-            
-            edited_df = st.data_editor(df.style.set_properties(**{'text-align': 'right'}), 
-                                       column_config=config, hide_index=True, key=f"d_{post.id}_{selected_date}", use_container_width=True)
-            
-            for _, r in edited_df.iterrows():
-                s_obj = db_session.query(Shift).get(r["ID"])
-                u_names = [r[f"שומר {j+1}"] for j in range(max_g) if f"שומר {j+1}" in r and r[f"שומר {j+1}"] != "-- פנוי --"]
-                new_assigned = ",".join([name_to_id[n] for n in u_names if n in name_to_id])
-                if s_obj.assigned_user_ids != new_assigned:
-                    s_obj.assigned_user_ids = new_assigned
+            render_post_column(ctx, post.id, selected_date, days_to_show, time_format_full)
 
-    if warnings_dict:
-        st.markdown('<div class="alert-box"><strong>🚨 חריגות בלוח:</strong><br/>' + 
-                    "<br/>".join([f"• {v}" for v in warnings_dict.values()]) + '</div>', unsafe_allow_html=True)
-
-    # מנגנון שמירה חי - דוחף למסד נתונים ועושה Rerun שקוף למסך
+    # מנגנון שמירה חי - כל עמודה שמרה את השינויים שלה, כאן רק עושים Rerun שקוף למסך
     if st.session_state.get("save_clicked"):
-        db_session.commit()
         st.session_state.save_clicked = False
         st.session_state.show_success = True
         st.rerun()
 
+    render_journal_diff(db_session, id_to_name)
+
+def save_manual_edits(db_session, manual_new, op_id=None):
+    # manual_new: מזהה משמרת -> רשימת מזהי שומרים. שאילתה אחת למשמרות שנערכו, עדכון אחד ורישום ביומן
+    changed = db_session.query(Shift).filter(Shift.id.in_(list(manual_new))).all()
+    manual_old = {s.id: s.assigned_user_ids for s in changed}
+    for s in changed:
+        s.assigned_user_ids = ",".join(str(uid) for uid in manual_new[s.id])
+    journal_changes(db_session, manual_old, changed, "manual", op_id=op_id)
+    db_session.commit()
+
+@st.fragment
+def render_post_column(ctx, post_id, selected_date, days_to_show, time_format_full):
+    # עריכה בעמדה אחת מריצה מחדש רק את העמודה הזו ואת ההתראות שלה, על ה-ctx של ההרצה המלאה האחרונה - בלי שאילתות.
+    # פונים ל-DB רק בשמירה, ורק למשמרות שנערכו
+    post = ctx["posts"][post_id]
+    id_to_name = {str(u.id): f"{u.name} ⭐" if u.is_commander else u.name for u in ctx["users"]}
+    name_to_id = {name: uid for uid, name in id_to_name.items()}
+    
+    st.markdown(f'<div class="post-header">{post.name} {"(👮‍♂️)" if post.requires_commander else ""}</div>', unsafe_allow_html=True)
+    p_shifts = sorted((s for s in ctx["shifts"].values() if s.post_id == post_id and ctx["start"] <= s.start < ctx["end"]), key=lambda s: (s.start, s.id))
+    
+    if not p_shifts:
+        st.caption("אין משמרות בטווח הזמן הזה.")
+        return
+
+    warnings_dict = shift_warnings(ctx, post_id=post_id)
+    shifts_by_id = {s.id: s for s in p_shifts}
+    data = []
+    max_g = max([s.required for s in p_shifts])
+    
+    for s in p_shifts:
+        err_mark = "🛑 " if s.id in warnings_dict else ""
+        s_start, s_end = from_minutes(s.start), from_minutes(s.end)
+        
+        s_f = s_start.strftime('%d/%m %H:%M') if days_to_show == 2 else s_start.strftime('%H:%M')
+        e_f = s_end.strftime('%H:%M')
+        t_str = f"{s_f} - {e_f}" if time_format_full else s_f
+        
+        row = {"ID": s.id, "זמן": f"{err_mark}{t_str}"}
+        for j in range(max_g):
+            row[f"שומר {j+1}"] = id_to_name.get(str(s.assigned[j]) if j < len(s.assigned) else "", "-- פנוי --")
+        data.append(row)
+    
+    df = pd.DataFrame(data)
+    df = df.iloc[:, ::-1] 
+    config = {"ID": None, "זמן": st.column_config.TextColumn(disabled=True)}
+    for j in range(max_g):
+        config[f"שומר {j+1}"] = st.column_config.SelectboxColumn(options=["-- פנוי --"] + list(name_to_id.keys()))
+    
+    edited_df = st.data_editor(df.style.set_properties(**{'text-align': 'right'}), 
+                               column_config=config, hide_index=True, key=f"d_{post_id}_{selected_date}", use_container_width=True)
+    
+    manual_new = {}
+    for _, r in edited_df.iterrows():
+        s_rec = shifts_by_id[r["ID"]]
+        u_names = [r[f"שומר {j+1}"] for j in range(max_g) if f"שומר {j+1}" in r and r[f"שומר {j+1}"] != "-- פנוי --"]
+        new_assigned = [int(name_to_id[n]) for n in u_names if n in name_to_id]
+        if new_assigned != s_rec.assigned:
+            manual_new[s_rec.id] = new_assigned
+    
+    # ההתראות משקפות גם עריכות שעוד לא נשמרו: מחילים אותן זמנית על ה-ctx ומשחזרים, כדי שלא יזלגו לעמודות אחרות
+    if manual_new:
+        restore = {sid: set_assigned(ctx, shifts_by_id[sid], uids) for sid, uids in manual_new.items()}
+        try:
+            warnings_dict = shift_warnings(ctx, post_id=post_id)
+        finally:
+            for sid, uids in restore.items(): set_assigned(ctx, shifts_by_id[sid], uids)
+    if warnings_dict:
+        st.markdown('<div class="alert-box"><strong>🚨 חריגות:</strong><br/>' + 
+                    "<br/>".join([f"• {v}" for v in warnings_dict.values()]) + '</div>', unsafe_allow_html=True)
+
+    if st.session_state.get("save_clicked") and manual_new:
+        with SessionLocal() as db_session:
+            save_manual_edits(db_session, manual_new, op_id=st.session_state.get("save_op_id"))
+
+JOURNAL_SOURCES = {"auto": "שיבוץ אוטומטי", "manual": "שמירה ידנית", "clear": "ניקוי לוח", "repair": "תיקון מקומי", "undo": "ביטול"}
+
+def render_journal_diff(db_session, id_to_name):
+    with st.expander("🕓 מה השתנה מאז..."):
+        c1, c2 = st.columns(2)
+        since_d = c1.date_input("מתאריך:", date.today(), key="journal_since_date")
+        since_t = c2.time_input("משעה:", time(0, 0), key="journal_since_time")
+        diff = assignment_diff_since(db_session, datetime.combine(since_d, since_t))
+        if not diff:
+            st.caption("לא נרשמו שינויים בלוח מאז.")
+            return
+        
+        shifts = {s.id: s for s in db_session.query(Shift).filter(Shift.id.in_(list(diff))).all()}
+        posts = {p.id: p.name for p in db_session.query(Post).all()}
+        names = lambda ids: ", ".join(id_to_name.get(x, x) for x in ids.split(",") if x) or "— פנוי —"
+        
+        d_data = []
+        for sid, (old, new, sources) in diff.items():
+            s = shifts.get(sid)
+            d_data.append({
+                "עמדה": posts.get(s.post_id, "") if s else "",
+                "משמרת": f"{s.start_time.strftime('%d/%m %H:%M')} - {s.end_time.strftime('%H:%M')}" if s else f"#{sid} (נמחקה)",
+                "לפני": names(old),
+                "אחרי": names(new),
+                "מקור": ", ".join(JOURNAL_SOURCES.get(x, x) for x in sorted(sources)),
+                "_start": s.start_time if s else datetime.min,
+            })
+        df_d = pd.DataFrame(d_data).sort_values("_start").drop(columns="_start").iloc[:, ::-1]
+        st.dataframe(df_d, hide_index=True, use_container_width=True)
+
 # ==========================================
 # 3.5. טאב תצוגה לצילום מסך (View Only)
 # ==========================================
@@ -515,10 +1226,13 @@ def render_screenshot_tab(db_session):
     end_view = start_view + timedelta(days=days_to_show)
     
     post_cols = st.columns(len(posts))
+    shifts_by_post = {}
+    for s in db_session.query(Shift).filter(Shift.start_time >= start_view, Shift.start_time < end_view).order_by(Shift.start_time).all():
+        shifts_by_post.setdefault(s.post_id, []).append(s)
     
     for i, post in enumerate(posts):
         with post_cols[i]:
-            p_shifts = db_session.query(Shift).filter(Shift.post_id == post.id, Shift.start_time >= start_view, Shift.start_time < end_view).order_by(Shift.start_time).all()
+            p_shifts = shifts_by_post.get(post.id, [])
             
             if not p_shifts:
                 continue
@@ -543,9 +1257,70 @@ def render_screenshot_tab(db_session):
                 df = pd.DataFrame(data)
                 st.table(df.style.set_properties(**{'text-align': 'right', 'background-color': '#ffffff'}))
 
+# ==========================================
+# 3.7. טאב תכנון - כיסוי מול זמינות
+# ==========================================
+def render_planning_tab(db_session):
+    st.header("📈 מפת כיסוי וזמינות")
+    st.caption("לכל שעה: כמה שומרים נדרשים מול כמה חיילים באמת זמינים (אחרי אילוצים, חסימות עמדה ומנוחה). "
+               "'יכולת' מתחשבת בכך שכל חייל צריך מנוחה של " + str(MIN_REST_HOURS) + " ש' בין משמרות, ולכן אינה תלויה בשיבוץ הנוכחי.")
+    
+    col1, col2 = st.columns(2)
+    p_date = col1.date_input("תאריך התחלה:", date.today(), key="planning_date")
+    p_days = col2.number_input("מספר ימים", min_value=1, max_value=31, value=7, key="planning_days")
+    
+    cov = compute_coverage(db_session, p_date, int(p_days))
+    if cov["required"].sum() == 0:
+        st.info("אין עמדות פעילות בטווח הזה.")
+        return
+    
+    # מפת חום: יום x שעה, ערך = יכולת פחות נדרש (שלילי = חסר)
+    cov["יום"] = cov["time"].dt.strftime('%d/%m')
+    cov["שעה"] = cov["time"].dt.hour
+    heat = cov.pivot(index="יום", columns="שעה", values="margin").reindex(cov["יום"].unique())
+    color = lambda v: f"background-color: {'#fecaca' if v < 0 else '#fef3c7' if v < 1 else '#d1fae5'}"
+    st.subheader("מרווח כוח אדם לפי שעה (יכולת פחות נדרש)")
+    st.dataframe(heat.style.map(color).format("{:.1f}"), use_container_width=True)
+    
+    short = cov[cov["margin"] < 0]
+    if short.empty:
+        st.success("אין חלונות חסרים בטווח הזה ✅")
+    else:
+        # איחוד שעות חסרות רצופות לחלונות
+        window_id = (cov["margin"] >= 0).cumsum()[short.index]
+        rows = []
+        for _, g in short.groupby(window_id):
+            rows.append({"מ-": g["time"].iloc[0].strftime('%d/%m %H:%M'), "עד": (g["time"].iloc[-1] + timedelta(hours=1)).strftime('%d/%m %H:%M'),
+                         "נדרש (מקס')": int(g["required"].max()), "זמינים (מינ')": int(g["available"].min()), "חוסר מקסימלי": round(float(-g["margin"].min()), 1)})
+        st.markdown(f'<div class="alert-box"><strong>🚨 {len(rows)} חלונות עם חוסר בכוח אדם</strong></div>', unsafe_allow_html=True)
+        st.table(pd.DataFrame(rows).iloc[:, ::-1].style.set_properties(**{'text-align': 'right'}))
+    
+    st.line_chart(cov.set_index("time")[["required", "capacity", "available"]].rename(columns={"required": "נדרש", "capacity": "יכולת", "available": "זמינים"}))
+
 # ==========================================
 # 4. טאב כוח אדם
 # ==========================================
+def add_users_bulk(db_session, names, is_commander=False):
+    # שאילתה אחת לשמות הקיימים ו-INSERT אחד לחדשים
+    names = list(dict.fromkeys(n.strip() for n in names if n.strip()))
+    existing = {n for n, in db_session.query(User.name).filter(User.name.in_(names)).all()}
+    new_users = [{"name": name, "is_commander": is_commander} for name in names if name not in existing]
+    if new_users: db_session.execute(insert(User), new_users)
+    db_session.commit()
+
+def save_personnel(db_session, to_update, to_delete):
+    # to_update: רשימת {"id", "name", "is_commander"} - נכתבת כ-executemany אחד
+    if to_delete:
+        db_session.query(User).filter(User.id.in_(to_delete)).delete(synchronize_session=False)
+    if to_update:
+        db_session.execute(update(User), to_update)
+    db_session.commit()
+
+def delete_by_ids(db_session, model, ids):
+    if ids:
+        db_session.query(model).filter(model.id.in_(ids)).delete(synchronize_session=False)
+    db_session.commit()
+
 def render_personnel_tab(db_session):
     st.header("ניהול כוח אדם ופילוח שעות 👥")
     
@@ -556,11 +1331,7 @@ def render_personnel_tab(db_session):
                 bulk_text = st.text_area("הדבק שמות (מופרדים בפסיק או שורה חדשה):")
                 is_cmds = st.checkbox("סמן את כולם כמפקדים (⭐)", False)
                 if st.form_submit_button("הוסף את כולם"):
-                    names = [n.strip() for n in bulk_text.replace(",", "\n").split("\n") if n.strip()]
-                    for name in names:
-                        if not db_session.query(User).filter_by(name=name).first():
-                            db_session.add(User(name=name, is_commander=is_cmds))
-                    db_session.commit()
+                    add_users_bulk(db_session, bulk_text.replace(",", "\n").split("\n"), is_cmds)
                     st.rerun()
 
     with col2:
@@ -579,31 +1350,41 @@ def render_personnel_tab(db_session):
                     t_from = c_col1.time_input("משעה:", time(8, 0))
                     t_to = c_col2.time_input("עד שעה:", time(12, 0))
                     c_reason = st.text_input("סיבה (אופציונלי):", "אילוץ אישי")
+                    c_repair = st.checkbox("🩹 תקן אוטומטית רק את המשמרות שמתנגשות באילוץ", True)
                     
                     if st.form_submit_button("שמור אילוץ"):
                         uid = db_session.query(User.id).filter_by(name=sel_user).scalar()
                         start_c = datetime.combine(c_date, t_from)
                         end_c = datetime.combine(c_date, t_to)
-                        db_session.add(Constraint(user_id=uid, start_time=start_c, end_time=end_c, reason=c_reason))
+                        new_c = Constraint(user_id=uid, start_time=start_c, end_time=end_c, reason=c_reason)
+                        db_session.add(new_c)
                         db_session.commit()
+                        if c_repair:
+                            st.session_state.repair_diff = describe_repair(db_session, repair_assignments(db_session, constraints=[new_c]))
                         st.toast(f"האילוץ נשמר בהצלחה.")
                         st.rerun()
 
     st.divider()
     users = db_session.query(User).all()
     posts = db_session.query(Post).all()
-    shifts = db_session.query(Shift).filter(Shift.assigned_user_ids != "").all()
+    
+    # מעבר אחד על ההיסטוריה במקום סריקה של כל המשמרות לכל חייל
+    hours, black_counts, post_hours = {}, {}, {}
+    for post_id, s_start, s_end, assigned in db_session.query(Shift.post_id, Shift.start_time, Shift.end_time, Shift.assigned_user_ids).filter(Shift.assigned_user_ids != "").all():
+        duration = (s_end - s_start).total_seconds() / 3600
+        is_black = is_black_shift(s_start, s_end)
+        for uid in (assigned or "").split(","):
+            if not uid: continue
+            uid = int(uid)
+            hours[uid] = hours.get(uid, 0.0) + duration
+            if is_black: black_counts[uid] = black_counts.get(uid, 0) + 1
+            post_hours[(uid, post_id)] = post_hours.get((uid, post_id), 0.0) + duration
     
     summary = []
     for u in users:
-        u_shifts = [s for s in shifts if str(u.id) in (s.assigned_user_ids or "").split(",")]
-        total_real_hours = sum([(s.end_time - s.start_time).total_seconds()/3600 for s in u_shifts])
-        black_shifts_count = sum(1 for s in u_shifts if is_black_shift(s.start_time, s.end_time))
-        
-        row = {"ID": u.id, "שם": u.name, "מפקד?": u.is_commander, "סה\"כ שעות": round(total_real_hours, 1), "משמרות 🌑": black_shifts_count}
+        row = {"ID": u.id, "שם": u.name, "מפקד?": u.is_commander, "סה\"כ שעות": round(hours.get(u.id, 0.0), 1), "משמרות 🌑": black_counts.get(u.id, 0)}
         for p in posts:
-            p_hrs = sum([(s.end_time - s.start_time).total_seconds()/3600 for s in u_shifts if s.post_id == p.id])
-            row[f"שעות ב-{p.name}"] = round(p_hrs, 1)
+            row[f"שעות ב-{p.name}"] = round(post_hours.get((u.id, p.id), 0.0), 1)
         row["למחיקה"] = False
         summary.append(row)
     
@@ -622,37 +1403,29 @@ def render_personnel_tab(db_session):
         ed_p = st.data_editor(df_sum.style.set_properties(**{'text-align': 'right'}), hide_index=True, use_container_width=True)
         
         if st.button("💾 שמור שינויים בכוח אדם", type="primary"):
-            for _, r in ed_p.iterrows():
-                u_obj = db_session.query(User).get(r["ID"])
-                if r["למחיקה"]: 
-                    db_session.delete(u_obj)
-                else: 
-                    u_obj.name = r["שם"]
-                    u_obj.is_commander = r["מפקד?"]
-            db_session.commit()
+            to_delete = [int(r["ID"]) for _, r in ed_p.iterrows() if r["למחיקה"]]
+            to_update = [{"id": int(r["ID"]), "name": r["שם"], "is_commander": bool(r["מפקד?"])} for _, r in ed_p.iterrows() if not r["למחיקה"]]
+            save_personnel(db_session, to_update, to_delete)
             st.rerun()
 
-    constraints = db_session.query(Constraint).all()
+    constraints = db_session.query(Constraint, User).outerjoin(User, Constraint.user_id == User.id).all()
     if constraints:
         with st.expander("📋 אילוצים רשומים במערכת"):
             c_data = []
-            for c in constraints:
-                u_obj = db_session.query(User).get(c.user_id)
-                u_n = f"{u_obj.name} ⭐" if u_obj.is_commander else u_obj.name
+            for c, u_obj in constraints:
+                u_n = "(נמחק)" if u_obj is None else f"{u_obj.name} ⭐" if u_obj.is_commander else u_obj.name
                 c_data.append({"ID": c.id, "חייל": u_n, "התחלה": c.start_time.strftime('%d/%m %H:%M'), "סיום": c.end_time.strftime('%d/%m %H:%M'), "סיבה": c.reason, "מחק": False})
             df_c = pd.DataFrame(c_data)
             df_c = df_c.iloc[:, ::-1] 
             ed_c = st.data_editor(df_c.style.set_properties(**{'text-align': 'right'}), hide_index=True, use_container_width=True)
             if st.button("מחק אילוצים מסומנים"):
-                for _, r in ed_c.iterrows():
-                    if r["מחק"]: db_session.delete(db_session.query(Constraint).get(r["ID"]))
-                db_session.commit()
+                delete_by_ids(db_session, Constraint, [int(r["ID"]) for _, r in ed_c.iterrows() if r["מחק"]])
                 st.rerun()
 
     st.markdown('<div class="danger-zone">', unsafe_allow_html=True)
     st.subheader("⚠️ אזור סכנה")
     if st.button("🔄 איפוס מונה שעות לכולם"):
-        for u in users: u.total_hours = 0
+        db_session.query(User).update({User.total_hours: 0}, synchronize_session=False)
         db_session.commit()
         st.rerun()
     st.markdown('</div>', unsafe_allow_html=True)
@@ -660,6 +1433,13 @@ def render_personnel_tab(db_session):
 # ==========================================
 # 5. טאב הגדרות
 # ==========================================
+def delete_posts(db_session, ids):
+    # עמדה נמחקת יחד עם המשמרות שלה
+    if ids:
+        db_session.query(Shift).filter(Shift.post_id.in_(ids)).delete(synchronize_session=False)
+        db_session.query(Post).filter(Post.id.in_(ids)).delete(synchronize_session=False)
+    db_session.commit()
+
 def render_settings_tab(db_session):
     st.header("הגדרות מערכת ⚙️")
     
@@ -702,11 +1482,7 @@ def render_settings_tab(db_session):
             df_p = df_p.iloc[:, ::-1] 
             ed_p = st.data_editor(df_p.style.set_properties(**{'text-align': 'right'}), hide_index=True, use_container_width=True)
             if st.button("מחק עמדות מסומנות"):
-                for _, r in ed_p.iterrows():
-                    if r["למחיקה"]: 
-                        db_session.query(Shift).filter_by(post_id=r["ID"]).delete()
-                        db_session.delete(db_session.query(Post).get(r["ID"]))
-                db_session.commit()
+                delete_posts(db_session, [int(r["ID"]) for _, r in ed_p.iterrows() if r["למחיקה"]])
                 st.rerun()
 
     with tab_rules:
@@ -743,12 +1519,12 @@ def render_settings_tab(db_session):
                                 st.success("הכלל נשמר בהצלחה!")
                                 st.rerun()
 
-            rules = db_session.query(PairingRule).all()
+            U1, U2 = aliased(User), aliased(User)
+            rules = db_session.query(PairingRule, U1.name, U2.name).outerjoin(U1, PairingRule.user1_id == U1.id).outerjoin(U2, PairingRule.user2_id == U2.id).all()
             if rules:
                 r_data = []
-                for r in rules:
-                    u1 = db_session.query(User).get(r.user1_id).name
-                    u2 = db_session.query(User).get(r.user2_id).name
+                for r, u1, u2 in rules:
+                    u1, u2 = u1 or "(נמחק)", u2 or "(נמחק)"
                     rt = "חמ\"ד 🟢" if r.rule_type == 'BUDDY' else "הפרדת כוחות 🔴"
                     r_data.append({"ID": r.id, "חייל א'": u1, "חייל ב'": u2, "סוג קשר": rt, "למחיקה": False})
                 
@@ -756,10 +1532,7 @@ def render_settings_tab(db_session):
                 df_r = df_r.iloc[:, ::-1] 
                 ed_r = st.data_editor(df_r.style.set_properties(**{'text-align': 'right'}), hide_index=True, use_container_width=True)
                 if st.button("מחק כללי זוגיות מסומנים"):
-                    for _, row in ed_r.iterrows():
-                        if row["למחיקה"]:
-                            db_session.query(PairingRule).filter_by(id=row["ID"]).delete()
-                    db_session.commit()
+                    delete_by_ids(db_session, PairingRule, [int(row["ID"]) for _, row in ed_r.iterrows() if row["למחיקה"]])
                     st.rerun()
         else:
             st.info("יש להוסיף לפחות 2 חיילים למערכת.")
@@ -775,35 +1548,35 @@ def render_settings_tab(db_session):
                     u_disp = col_u.selectbox("בחר חייל:", u_names)
                     u_name = raw_names[u_names.index(u_disp)]
                     p_name = col_p.selectbox("בחר עמדה שחסומה לו:", [p.name for p in posts])
+                    pc_repair = st.checkbox("🩹 תקן אוטומטית משמרות עתידיות שלו בעמדה זו", True)
                     
                     if st.form_submit_button("שמור אילוץ עמדה"):
                         u_id = next(u.id for u in users if u.name == u_name)
                         p_id = next(p.id for p in posts if p.name == p_name)
                         if not db_session.query(PostConstraint).filter_by(user_id=u_id, post_id=p_id).first():
-                            db_session.add(PostConstraint(user_id=u_id, post_id=p_id))
+                            new_pc = PostConstraint(user_id=u_id, post_id=p_id)
+                            db_session.add(new_pc)
                             db_session.commit()
+                            if pc_repair:
+                                st.session_state.repair_diff = describe_repair(db_session, repair_assignments(db_session, post_constraints=[new_pc]))
                             st.success("אילוץ העמדה נשמר!")
                             st.rerun()
                         else:
                             st.warning("האילוץ הזה כבר קיים במערכת.")
                             
-            pcs = db_session.query(PostConstraint).all()
+            pcs = db_session.query(PostConstraint, User, Post.name).outerjoin(User, PostConstraint.user_id == User.id).outerjoin(Post, PostConstraint.post_id == Post.id).all()
             if pcs:
                 pc_data = []
-                for pc in pcs:
-                    u_obj = db_session.query(User).get(pc.user_id)
-                    u_n = f"{u_obj.name} ⭐" if u_obj.is_commander else u_obj.name
-                    p_n = db_session.query(Post).get(pc.post_id).name
+                for pc, u_obj, p_n in pcs:
+                    u_n = "(נמחק)" if u_obj is None else f"{u_obj.name} ⭐" if u_obj.is_commander else u_obj.name
+                    p_n = p_n or "(נמחקה)"
                     pc_data.append({"ID": pc.id, "חייל": u_n, "עמדה חסומה": p_n, "למחיקה": False})
                 
                 df_pc = pd.DataFrame(pc_data)
                 df_pc = df_pc.iloc[:, ::-1] 
                 ed_pc = st.data_editor(df_pc.style.set_properties(**{'text-align': 'right'}), hide_index=True, use_container_width=True)
                 if st.button("מחק אילוצי עמדה מסומנים"):
-                    for _, row in ed_pc.iterrows():
-                        if row["למחיקה"]:
-                            db_session.query(PostConstraint).filter_by(id=row["ID"]).delete()
-                    db_session.commit()
+                    delete_by_ids(db_session, PostConstraint, [int(row["ID"]) for _, row in ed_pc.iterrows() if row["למחיקה"]])
                     st.rerun()
 
     with tab_sys:
@@ -826,22 +1599,13 @@ def render_settings_tab(db_session):
 
         st.divider()
         st.subheader("📅 מחולל משמרות ריקות")
-        g_date = st.date_input("יום לייצור (מייצר 24 שעות מיום זה):", date.today())
+        g_col1, g_col2 = st.columns(2)
+        g_date = g_col1.date_input("יום לייצור (מייצר 24 שעות מיום זה):", date.today())
+        g_days = g_col2.number_input("מספר ימים", min_value=1, max_value=31, value=1)
         if st.button("ייצר סלוטים ריקים לתאריך זה", type="primary"):
-            for p in posts:
-                curr = datetime.combine(g_date, time(0,0))
-                while curr < datetime.combine(g_date, time(0,0)) + timedelta(days=1):
-                    if is_time_in_range(p.active_from, p.active_to, curr.time()):
-                        req = p.required_guards
-                        if p.boost_guards > 0 and is_time_in_range(p.boost_from, p.boost_to, curr.time()):
-                            req += p.boost_guards
-                        if not db_session.query(Shift).filter_by(post_id=p.id, start_time=curr).first():
-                            db_session.add(Shift(post_id=p.id, start_time=curr, 
-                                               end_time=curr + timedelta(minutes=p.shift_length_minutes),
-                                               required_count=req))
-                    curr += timedelta(minutes=p.shift_length_minutes)
-            db_session.commit()
-            st.success("סלוטים נוצרו בהצלחה!")
+            _, created = start_job(db_session, "generate_slots", {"date": g_date.isoformat(), "days": int(g_days)})
+            if created: st.rerun()
+            st.warning("ייצור סלוטים כבר רץ ברקע - ממתינים לסיומו.")
 
         st.markdown('<div class="danger-zone">', unsafe_allow_html=True)
         if st.button("🗑️ מחיקת כל הסלוטים (לכל התאריכים)"):
@@ -853,15 +1617,31 @@ def render_settings_tab(db_session):
 # ==========================================
 # 6. Main
 # ==========================================
+def run_page(render_fn):
+    # כל עמוד מקבל סשן משלו ורק העמוד שנבחר רץ
+    def page():
+        db_session = SessionLocal()
+        try:
+            render_fn(db_session)
+        finally:
+            db_session.close()
+    return page
+
 def main():
-    db_session = SessionLocal()
     st.title("ניהול שמירות מילואים 🇮🇱")
-    t1, t2, t3, t4 = st.tabs(["דשבורד 🛡️", "צילום מסך 📸", "כוח אדם 👥", "הגדרות ⚙️"])
-    with t1: render_dashboard_tab(db_session)
-    with t2: render_screenshot_tab(db_session)
-    with t3: render_personnel_tab(db_session)
-    with t4: render_settings_tab(db_session)
+    nav = st.navigation([
+        st.Page(run_page(render_dashboard_tab), title="דשבורד", icon="🛡️", url_path="dashboard", default=True),
+        st.Page(run_page(render_screenshot_tab), title="צילום מסך", icon="📸", url_path="screenshot"),
+        st.Page(run_page(render_planning_tab), title="תכנון", icon="📈", url_path="planning"),
+        st.Page(run_page(render_personnel_tab), title="כוח אדם", icon="👥", url_path="personnel"),
+        st.Page(run_page(render_settings_tab), title="הגדרות", icon="⚙️", url_path="settings"),
+    ], position="top")
+    
+    db_session = SessionLocal()
+    render_repair_diff()
+    render_jobs_panel(db_session)
     db_session.close()
+    nav.run()
 
 if __name__ == "__main__": main()
 
@@ -0,0 +1,71 @@
+import os
+import sys
+import random
+
+# DB בזיכרון לפני שהאפליקציה יוצרת את ה-engine - לעולם לא נוגעים בקובץ האמיתי
+os.environ["SHIFTS_DB_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idf_shifts as app
+
+LONG_AFTER = 24 * 60
+
+
+def build(seed_=1, n=20000, n_removed=300):
+    # אינטרוולים קצרים וארוכים (מעל long_after) לשני חיילים, ואחר כך מחיקות אקראיות
+    rnd = random.Random(seed_)
+    idx, ref = app.IntervalIndex(long_after=LONG_AFTER), []
+    for key in range(n):
+        uid = rnd.choice((1, 2))
+        start = rnd.randint(0, 10**6)
+        end = start + rnd.choice((60, 120, 240, LONG_AFTER, LONG_AFTER + 1, 3000, 10000))
+        idx.add(uid, start, end, key)
+        ref.append((uid, start, end, key))
+    for it in rnd.sample(ref, n_removed):
+        idx.remove(*it)
+        ref.remove(it)
+    return idx, ref, rnd
+
+
+def test_overlapping_matches_brute_force():
+    idx, ref, rnd = build()
+    for _ in range(200):
+        uid = rnd.choice((1, 2))
+        a = rnd.randint(0, 10**6)
+        b = a + rnd.randint(1, 5000)
+        expected = sorted((s, e, k) for u, s, e, k in ref if u == uid and s < b and e > a)
+        assert sorted(idx.overlapping(uid, a, b)) == expected
+        
+        exclude = expected[0][2] if expected and rnd.random() < 0.5 else None
+        assert idx.overlaps(uid, a, b, exclude=exclude) == any(k != exclude for _, _, k in expected)
+
+
+def test_last_before_and_first_after_match_brute_force():
+    idx, ref, rnd = build(seed_=2)
+    for _ in range(200):
+        uid = rnd.choice((1, 2))
+        t = rnd.randint(0, 10**6)
+        mine = [(s, e, k) for u, s, e, k in ref if u == uid]
+        
+        before = [it for it in mine if it[1] <= t]
+        exclude = max(before, key=lambda it: (it[1], it[0], it[2]))[2] if before and rnd.random() < 0.5 else None
+        before = [it for it in before if it[2] != exclude]
+        assert idx.last_before(uid, t, exclude=exclude) == (max(before, key=lambda it: (it[1], it[0], it[2])) if before else None)
+        
+        after = [it for it in mine if it[0] >= t]
+        exclude = min(after)[2] if after and rnd.random() < 0.5 else None
+        after = [it for it in after if it[2] != exclude]
+        assert idx.first_after(uid, t, exclude=exclude) == (min(after) if after else None)
+
+
+def test_long_interval_is_found_and_removed():
+    # חופשה ארוכה שמתחילה הרבה לפני חלון הסריקה של הקצרים עדיין נמצאת, ו-exclude/remove מוציאים אותה
+    idx = app.IntervalIndex(long_after=LONG_AFTER)
+    for k in range(100):
+        idx.add(1, k * 180, k * 180 + 120, k)
+    idx.add(1, 0, 10 * LONG_AFTER, -1)
+    assert idx.overlapping(1, 9130, 9140) == [(0, 10 * LONG_AFTER, -1)]
+    assert idx.overlaps(1, 9130, 9140)
+    assert not idx.overlaps(1, 9130, 9140, exclude=-1)
+    idx.remove(1, 0, 10 * LONG_AFTER, -1)
+    assert idx.overlapping(1, 9130, 9140) == []
+    assert idx.last_before(1, 10**6) == (99 * 180, 99 * 180 + 120, 99)
@@ -0,0 +1,46 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+# DB בזיכרון לפני שהאפליקציה יוצרת את ה-engine - לעולם לא נוגעים בקובץ האמיתי
+os.environ["SHIFTS_DB_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idf_shifts as app
+
+
+def reset():
+    app.Base.metadata.drop_all(app.engine)
+    app.Base.metadata.create_all(app.engine)
+    db = app.SessionLocal()
+    db.add_all([app.User(name=f"u{i}") for i in range(3)])
+    db.add(app.Post(name="שער"))
+    db.commit()
+    t0 = datetime(2026, 10, 20, 8)
+    db.add_all([app.Shift(post_id=1, start_time=t0 + timedelta(hours=4 * i), end_time=t0 + timedelta(hours=4 * i + 4),
+                          required_count=1, assigned_user_ids="") for i in range(2)])
+    db.commit()
+    return db
+
+
+def test_undo_skips_operations_whose_shifts_were_deleted():
+    db = reset()
+    app.save_manual_edits(db, {1: [1]})
+    app.save_manual_edits(db, {2: [2]})
+    db.query(app.Shift).filter(app.Shift.id == 2).delete(synchronize_session=False)
+    db.commit()
+    
+    # הפעולה האחרונה כבר לא ניתנת לביטול - מגיעים לזו שלפניה
+    assert app.undo_last_operation(db) == ("manual", 1, 0)
+    db.expire_all()
+    assert db.get(app.Shift, 1).assigned_user_ids == ""
+
+
+def test_undo_does_not_repeat_an_operation_that_cannot_apply():
+    db = reset()
+    app.save_manual_edits(db, {1: [1]})
+    app.save_manual_edits(db, {2: [2]})
+    db.query(app.Shift).delete()
+    db.commit()
+    
+    assert app.undo_last_operation(db) == (None, 0, 0)
+    assert app.undo_last_operation(db) == (None, 0, 0)
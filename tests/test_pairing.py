@@ -0,0 +1,57 @@
+import os
+import sys
+from datetime import datetime, date, timedelta
+
+# DB בזיכרון לפני שהאפליקציה יוצרת את ה-engine - לעולם לא נוגעים בקובץ האמיתי
+os.environ["SHIFTS_DB_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idf_shifts as app
+
+DAY = date(2026, 10, 20)
+T0 = datetime(2026, 10, 20, 8)
+
+
+def test_compile_pairing_rules_merges_buddy_chains():
+    buddies, anti = app.compile_pairing_rules([(1, 2, "BUDDY"), (3, 2, "BUDDY"), (4, 5, "BUDDY"), (1, 6, "ANTI_BUDDY")])
+    assert buddies[1] == buddies[2] == buddies[3] == (1, 2, 3)
+    assert buddies[4] == buddies[5] == (4, 5)
+    assert 6 not in buddies
+    assert anti == {1: {6}, 6: {1}}
+
+
+def seed(names):
+    # עמדה של 2 שומרים ב-13:00; A ו-B חמ"ד ו-B חסום, X ו-Y סיימו משמרת שעה לפני (מנוחה של שעה)
+    app.Base.metadata.drop_all(app.engine)
+    app.Base.metadata.create_all(app.engine)
+    db = app.SessionLocal()
+    db.add_all([app.User(name=n) for n in names])
+    db.add_all([app.Post(name=f"p{i}") for i in range(3)])
+    db.commit()
+    ids = {u.name: u.id for u in db.query(app.User)}
+    
+    db.add(app.PairingRule(user1_id=ids["A"], user2_id=ids["B"], rule_type="BUDDY"))
+    db.add(app.Constraint(user_id=ids["B"], start_time=T0, end_time=T0 + timedelta(hours=12), reason="x"))
+    db.add(app.Shift(post_id=2, start_time=T0, end_time=T0 + timedelta(hours=4), required_count=1, assigned_user_ids=str(ids["X"])))
+    db.add(app.Shift(post_id=3, start_time=T0, end_time=T0 + timedelta(hours=4), required_count=1, assigned_user_ids=str(ids["Y"])))
+    target = app.Shift(post_id=1, start_time=T0 + timedelta(hours=5), end_time=T0 + timedelta(hours=9), required_count=2, assigned_user_ids="")
+    db.add(target)
+    db.commit()
+    return db, ids, target.id
+
+
+def assigned_names(db, ids, shift_id):
+    by_id = {v: k for k, v in ids.items()}
+    db.expire_all()
+    return {by_id[int(x)] for x in db.get(app.Shift, shift_id).assigned_user_ids.split(",") if x}
+
+
+def test_rested_buddy_is_seated_alone_before_an_unrested_soldier():
+    db, ids, target = seed(["A", "B", "X", "Y"])
+    app.auto_assign_shifts(db, DAY)
+    assert "A" in assigned_names(db, ids, target)
+
+
+def test_buddy_defers_only_to_rested_candidates():
+    db, ids, target = seed(["A", "B", "X", "Y", "Z"])
+    app.auto_assign_shifts(db, DAY)
+    assert assigned_names(db, ids, target) == {"A", "Z"}
@@ -0,0 +1,120 @@
+import os
+import sys
+from contextlib import contextmanager
+from datetime import datetime, date, time, timedelta
+
+import pytest
+from sqlalchemy import event
+from streamlit.testing.v1 import AppTest
+
+# DB בזיכרון לפני שהאפליקציה יוצרת את ה-engine - לעולם לא נוגעים בקובץ האמיתי
+os.environ["SHIFTS_DB_URL"] = "sqlite://"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import idf_shifts as app
+
+SIZES = (3, 9)
+
+
+def seed(n):
+    app.Base.metadata.drop_all(app.engine)
+    app.Base.metadata.create_all(app.engine)
+    db = app.SessionLocal()
+    n_users = 6 * n
+    db.add_all([app.User(name=f"u{i}", is_commander=i % 4 == 0) for i in range(n_users)])
+    db.add_all([app.Post(name=f"p{i}", shift_length_minutes=240, required_guards=3, active_from=time(0, 0), active_to=time(23, 59),
+                         boost_from=time(0, 0), boost_to=time(0, 0), boost_guards=0, requires_commander=i == 0) for i in range(n)])
+    db.commit()
+
+    t0 = datetime.combine(date.today(), time(0, 0))
+    k = 0
+    for p in range(1, n + 1):
+        for h in range(0, 48, 4):
+            assigned = f"{k % n_users + 1},{(k + 1) % n_users + 1}"
+            db.add(app.Shift(post_id=p, start_time=t0 + timedelta(hours=h), end_time=t0 + timedelta(hours=h + 4), required_count=3, assigned_user_ids=assigned))
+            k += 2
+    for i in range(1, n + 1):
+        db.add(app.Constraint(user_id=i, start_time=t0 + timedelta(hours=i), end_time=t0 + timedelta(hours=i + 2), reason="x"))
+        db.add(app.PairingRule(user1_id=2 * i, user2_id=2 * i + 1, rule_type="BUDDY" if i % 2 else "ANTI_BUDDY"))
+        db.add(app.PostConstraint(user_id=i, post_id=i))
+    db.commit()
+
+    shifts = db.query(app.Shift).order_by(app.Shift.id).limit(n).all()
+    app.journal_values(db, {s.id: "" for s in shifts}, {s.id: s.assigned_user_ids for s in shifts}, "manual")
+    db.commit()
+    db.close()
+
+
+@contextmanager
+def count_statements():
+    count = [0]
+    def on_execute(*args):
+        count[0] += 1
+    event.listen(app.engine, "before_cursor_execute", on_execute)
+    try:
+        yield count
+    finally:
+        event.remove(app.engine, "before_cursor_execute", on_execute)
+
+
+def _render_page():
+    import streamlit as st
+    import idf_shifts
+    db_session = idf_shifts.SessionLocal()
+    try:
+        getattr(idf_shifts, st.session_state["render"])(db_session)
+    finally:
+        db_session.close()
+
+
+@pytest.mark.parametrize("render", ["render_dashboard_tab", "render_screenshot_tab", "render_planning_tab",
+                                    "render_personnel_tab", "render_settings_tab"])
+def test_render_statement_count_does_not_grow(render):
+    counts = []
+    for n in SIZES:
+        seed(n)
+        at = AppTest.from_function(_render_page, default_timeout=60)
+        at.session_state["render"] = render
+        with count_statements() as count:
+            at.run()
+        assert not at.exception, at.exception
+        counts.append(count[0])
+    assert counts[0] == counts[1], f"{render}: {counts[0]} statements at size {SIZES[0]}, {counts[1]} at size {SIZES[1]}"
+
+
+def _ids(db, model):
+    return [i for i, in db.query(model.id).order_by(model.id).all()]
+
+def _first_shift_ids(db, n):
+    return _ids(db, app.Shift)[:n]
+
+def _repair_future_seat(db):
+    # חסימת עמדה לחייל ששובץ בה למשמרת עתידית - בדיוק משמרת אחת מתנגשת בשני הגדלים
+    s = db.query(app.Shift).filter(app.Shift.start_time > datetime.now()).order_by(app.Shift.start_time).first()
+    uid = int(s.assigned_user_ids.split(",")[0])
+    return app.repair_assignments(db, post_constraints=[app.PostConstraint(user_id=uid, post_id=s.post_id)])
+
+SAVES = {
+    "add_users_bulk": lambda db, n: app.add_users_bulk(db, [f"new{i}" for i in range(n)] + ["u0"]),
+    "save_personnel": lambda db, n: app.save_personnel(
+        db, [{"id": uid, "name": f"x{uid}", "is_commander": True} for uid in _ids(db, app.User)[n:]], _ids(db, app.User)[:n]),
+    "delete_constraints": lambda db, n: app.delete_by_ids(db, app.Constraint, _ids(db, app.Constraint)),
+    "delete_pairing_rules": lambda db, n: app.delete_by_ids(db, app.PairingRule, _ids(db, app.PairingRule)),
+    "delete_post_constraints": lambda db, n: app.delete_by_ids(db, app.PostConstraint, _ids(db, app.PostConstraint)),
+    "delete_posts": lambda db, n: app.delete_posts(db, _ids(db, app.Post)[1:]),
+    "save_manual_edits": lambda db, n: app.save_manual_edits(db, {sid: [1, 2] for sid in _first_shift_ids(db, n)}),
+    "undo_last_operation": lambda db, n: app.undo_last_operation(db),
+    "auto_assign_shifts": lambda db, n: app.auto_assign_shifts(db, date.today(), 2),
+    "repair_assignments": lambda db, n: _repair_future_seat(db),
+}
+
+
+@pytest.mark.parametrize("save", list(SAVES))
+def test_save_statement_count_does_not_grow(save):
+    counts = []
+    for n in SIZES:
+        seed(n)
+        with app.SessionLocal() as db:
+            with count_statements() as count:
+                SAVES[save](db, n)
+        counts.append(count[0])
+    assert counts[0] == counts[1], f"{save}: {counts[0]} statements at size {SIZES[0]}, {counts[1]} at size {SIZES[1]}"